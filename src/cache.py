@@ -0,0 +1,284 @@
+"""
+Cachés del bot: L1 en memoria del proceso + L2 compartida en Redis (opcional).
+
+L1 (TTLCache): diccionario LRU con expiración, sin red. Para claves muy calientes.
+L2 (Redis): compartida entre procesos/reinicios. Si REDIS_URL no está configurada o el paquete redis no está instalado,
+las lecturas se comportan como un fallo de caché y las escrituras no
+hacen nada: el bot sigue consultando APIs/BD exactamente igual.
+
+CONVENCIÓN DE CLAVES:
+- servicio:entidad:id:variante  (ej: nutri:off:8431890069843:v1)
+- Subir la variante (v1 → v2) invalida todo lo guardado con el formato anterior
+
+REFRESCO ANTICIPADO:
+Cuando a una clave le queda menos del 20% de su TTL, una pequeña fracción
+de lecturas se trata como fallo. Así un solo proceso refresca el valor
+antes de que caduque, en lugar de que todos lo hagan a la vez (estampida).
+"""
+
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import orjson
+
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+from src.config import REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+if REDIS_URL and not REDIS_AVAILABLE:
+    logger.warning("⚠️ REDIS_URL configurada pero redis no está instalado: pip install redis")
+
+# Fracción del TTL por debajo de la cual se puede refrescar antes de tiempo
+EARLY_REFRESH_FRACTION = 0.2
+# Probabilidad de que una lectura en esa ventana dispare el refresco (1/N)
+EARLY_REFRESH_PROBABILITY = 1 / 10
+
+_redis = None
+
+
+# ==========================================
+# L1 - CACHÉ EN MEMORIA (por proceso)
+# ==========================================
+
+class TTLCache:
+    """
+    Caché LRU acotada con expiración por entrada.
+    
+    - Al superar maxsize se descarta la entrada usada hace más tiempo
+    - Cada entrada caduca a los `ttl` segundos (se puede sobrescribir en set)
+    - Pensada para un único event loop: no usa locks
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+    
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+    
+    def clear(self) -> None:
+        self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# ==========================================
+# L2 - REDIS (compartida)
+# ==========================================
+
+def get_redis():
+    """Cliente Redis compartido (lazy). None si la caché está desactivada."""
+    global _redis
+    if _redis is None and REDIS_URL and REDIS_AVAILABLE:
+        _redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+    return _redis
+
+
+async def cache_get_json(key: str, ttl: Optional[int] = None) -> Optional[Any]:
+    """
+    Lee un valor JSON de Redis.
+    
+    Args:
+        key: Clave a leer
+        ttl: TTL con el que se guardó la clave. Si se indica, activa el
+             refresco anticipado probabilístico.
+    
+    Returns:
+        El valor deserializado, o None si no existe (o toca refrescar)
+    """
+    r = get_redis()
+    if r is None:
+        return None
+    
+    try:
+        if ttl:
+            async with r.pipeline(transaction=False) as pipe:
+                raw, remaining = await pipe.get(key).ttl(key).execute()
+            if (
+                raw is not None
+                and 0 <= remaining < ttl * EARLY_REFRESH_FRACTION
+                and random.random() < EARLY_REFRESH_PROBABILITY
+            ):
+                return None
+        else:
+            raw = await r.get(key)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis GET {key} falló: {e}")
+        return None
+    
+    return orjson.loads(raw) if raw is not None else None
+
+
+async def cache_set_json(key: str, value: Any, ttl: int) -> None:
+    """Guarda un valor JSON en Redis con expiración (segundos)."""
+    r = get_redis()
+    if r is None:
+        return
+    
+    try:
+        await r.set(key, orjson.dumps(value), ex=ttl)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis SET {key} falló: {e}")
+
+
+async def cache_delete(key: str) -> None:
+    """Elimina una clave de Redis (invalidación explícita)."""
+    r = get_redis()
+    if r is None:
+        return
+    
+    try:
+        await r.delete(key)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis DEL {key} falló: {e}")
+
+
+async def cache_try_lock(key: str, ttl: int) -> bool:
+    """
+    Cerrojo distribuido best-effort (SET NX EX) para single-flight entre procesos.
+    
+    Returns:
+        True si este proceso debe hacer el trabajo: consiguió el cerrojo o Redis
+        no está disponible (sin Redis no hay con quién coordinarse).
+    """
+    r = get_redis()
+    if r is None:
+        return True
+    
+    try:
+        return bool(await r.set(key, "1", nx=True, ex=ttl))
+    except Exception as e:
+        logger.warning(f"⚠️ Redis SET NX {key} falló: {e}")
+        return True
+
+
+# Suma solo si el hash ya existe: incrementar un hash ausente crearía
+# unos totales parciales que se leerían como si fueran los del día completo.
+# Con KEYS[2] (versión) se incrementa también el contador de escrituras
+_HINCRBY_IF_EXISTS = """
+if #KEYS > 1 then
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[1])
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+for i = 2, #ARGV, 2 do redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1]) end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+async def cache_get_hash(key: str) -> Optional[Dict[str, int]]:
+    """Lee un hash de contadores enteros (HGETALL). None si no existe."""
+    r = get_redis()
+    if r is None:
+        return None
+    
+    try:
+        raw = await r.hgetall(key)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis HGETALL {key} falló: {e}")
+        return None
+    
+    return {field: int(value) for field, value in raw.items()} if raw else None
+
+
+# Rellena el hash solo si nadie ha escrito desde que se leyó la versión:
+# así un SUM calculado antes de una escritura no pisa el total ya actualizado
+_HSET_IF_VERSION = """
+if tonumber(redis.call('GET', KEYS[2]) or '0') ~= tonumber(ARGV[2]) then return 0 end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+async def cache_get_counter(key: str) -> Optional[int]:
+    """Lee un contador entero (0 si no existe). None si Redis no está disponible."""
+    r = get_redis()
+    if r is None:
+        return None
+    
+    try:
+        return int(await r.get(key) or 0)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis GET {key} falló: {e}")
+        return None
+
+
+async def cache_set_hash_if_version(
+    key: str, mapping: Dict[str, int], ttl: int, version_key: str, version: int
+) -> None:
+    """Sustituye un hash completo solo si `version_key` sigue valiendo `version`."""
+    r = get_redis()
+    if r is None:
+        return
+    
+    args = [ttl, version]
+    for field, value in mapping.items():
+        args += [field, value]
+    
+    try:
+        await r.eval(_HSET_IF_VERSION, 2, key, version_key, *args)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis HSET {key} falló: {e}")
+
+
+async def cache_incr_hash(
+    key: str, deltas: Dict[str, int], ttl: int, version_key: Optional[str] = None
+) -> None:
+    """
+    Aplica HINCRBY atómico a varios campos de un hash, solo si ya está en caché.
+    Con `version_key` incrementa además ese contador (ver cache_set_hash_if_version).
+    """
+    r = get_redis()
+    if r is None:
+        return
+    
+    keys = [key] if version_key is None else [key, version_key]
+    args = [ttl]
+    for field, delta in deltas.items():
+        args += [field, delta]
+    
+    try:
+        await r.eval(_HINCRBY_IF_EXISTS, len(keys), *keys, *args)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis HINCRBY {key} falló: {e}")
+        # Mejor perder la entrada que dejar unos totales desfasados
+        await cache_delete(key)
+
+
+async def close_cache() -> None:
+    """Cierra la conexión a Redis (si se abrió)."""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
@@ -70,6 +70,19 @@ BARCODE_LOOKUP_KEY = os.getenv("BARCODE_LOOKUP_KEY", "")
 
 UPC_DATABASE_API = "https://api.upcitemdb.com/prod/trial/lookup"
 
+# ==========================================
+# DETECCIÓN DE CÓDIGOS DE BARRAS
+# ==========================================
+# Hilos para visión (rotaciones en paralelo). En el plan gratuito de Render
+# (2 núcleos) conviene fijar BARCODE_WORKERS=2
+BARCODE_WORKERS = int(os.getenv("BARCODE_WORKERS", min(4, os.cpu_count() or 1)))
+
+# ==========================================
+# REDIS (Caché compartida, opcional)
+# ==========================================
+# Si no se define, el bot funciona igual pero sin caché compartida
+REDIS_URL = os.getenv("REDIS_URL")
+
 # ==========================================
 # POSTGRESQL - SUPABASE
 # ==========================================
@@ -96,6 +109,9 @@ if not DATABASE_URL.startswith("postgresql://"):
         "Valor actual: " + DATABASE_URL[:30] + "..."
     )
 
+# Réplica de solo lectura (opcional). Si no se define, las lecturas usan el pool principal
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+
 # ==========================================
 # LÓGICA DEL "DÍA" (Nutrición)
 # ==========================================
@@ -13,14 +13,18 @@ CONCEPTOS CLAVE:
 """
 
 import asyncpg
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, time
-from typing import Optional, List, Dict, Tuple
+from typing import Optional, List, Dict, Tuple, AsyncIterator
 from dataclasses import dataclass
 import os
 import socket
 import urllib.parse
 
-from src.config import LOGICAL_DAY_START_HOUR
+from src.config import LOGICAL_DAY_START_HOUR, DATABASE_READ_URL
+from src.cache import (
+    TTLCache, cache_get_hash, cache_get_counter, cache_set_hash_if_version, cache_incr_hash
+)
 
 
 # ==========================================
@@ -98,6 +102,51 @@ def get_logical_day_end(date: datetime = None) -> datetime:
     return start + timedelta(hours=24) - timedelta(seconds=1)
 
 
+# Inicio del día lógico calculado dentro de PostgreSQL.
+# LOCALTIMESTAMP usa la misma zona horaria de sesión con la que CURRENT_TIMESTAMP
+# rellena food_logs.timestamp, y el texto SQL es constante para todos los usuarios.
+LOGICAL_DAY_START_SQL = (
+    f"date_trunc('day', LOCALTIMESTAMP - interval '{LOGICAL_DAY_START_HOUR} hours')"
+    f" + interval '{LOGICAL_DAY_START_HOUR} hours'"
+)
+
+
+# ==========================================
+# CACHÉ DE TOTALES DEL DÍA (Redis, opcional)
+# ==========================================
+
+# Algo más de un día: la clave del día anterior caduca sola
+TODAY_TOTALS_TTL = 30 * 3600
+
+
+# Diferencia entre el reloj de la sesión PostgreSQL (LOCALTIMESTAMP) y el del
+# proceso. Si sus zonas horarias no coinciden, el día lógico de la clave debe
+# salir del reloj de la BD, que es el que acota el SUM
+_db_clock_offset = timedelta(0)
+
+
+def _sync_db_clock(db_now: datetime) -> None:
+    """Actualiza el desfase con un LOCALTIMESTAMP recién leído (redondeado a 15 min)."""
+    global _db_clock_offset
+    quarters = round((db_now - datetime.now()) / timedelta(minutes=15))
+    _db_clock_offset = quarters * timedelta(minutes=15)
+
+
+def _today_totals_key(user_id: int, db_now: Optional[datetime] = None) -> str:
+    """
+    Clave del hash con los totales del día lógico del usuario.
+    db_now: LOCALTIMESTAMP devuelto por la misma sentencia (si no, se estima).
+    """
+    if db_now is None:
+        db_now = datetime.now() + _db_clock_offset
+    return f"nutri:today:{user_id}:{get_logical_day_start(db_now).date().isoformat()}:v1"
+
+
+def _today_totals_version_key(user_id: int) -> str:
+    """Contador de escrituras del usuario: evita rellenar la caché con un SUM viejo."""
+    return f"nutri:today:{user_id}:ver"
+
+
 # ==========================================
 # CLASE PRINCIPAL - DATABASE MANAGER
 # ==========================================
@@ -105,14 +154,19 @@ def get_logical_day_end(date: datetime = None) -> datetime:
 class Database:
     """Gestor centralizado de PostgreSQL con pool de conexiones."""
     
-    def __init__(self, database_url: str = None):
+    def __init__(self, database_url: str = None, read_database_url: str = None):
         self.database_url = database_url or os.environ.get("DATABASE_URL")
         if not self.database_url:
             raise ValueError(
                 "DATABASE_URL no configurada. "
                 "Agrega DATABASE_URL a tu archivo .env"
             )
+        self.read_database_url = read_database_url or DATABASE_READ_URL
         self.pool: Optional[asyncpg.Pool] = None
+        # Pool para consultas de solo lectura. Sin réplica configurada es el mismo pool principal
+        self.read_pool: Optional[asyncpg.Pool] = None
+        # Usuarios ya leídos: casi todos los mensajes empiezan por get_or_create_user
+        self._user_cache = TTLCache(maxsize=10_000, ttl=3600)
     
     # ========== CONEXIÓN Y POOL ==========
     
@@ -148,6 +202,7 @@ class Database:
                     ssl='require' if 'localhost' not in self.database_url else False
                 )
                 print("✅ Pool de conexiones PostgreSQL creado")
+                _sync_db_clock(await self.pool.fetchval("SELECT LOCALTIMESTAMP"))
             except OSError as e:
                 print(f"❌ Error de conexión de red a Supabase: {str(e)}")
                 print("\n📋 DIAGNÓSTICO:")
@@ -170,12 +225,44 @@ class Database:
             except Exception as e:
                 print(f"❌ Error conectando a PostgreSQL: {type(e).__name__}: {str(e)}")
                 raise
+        
+        if self.read_pool is None:
+            if self.read_database_url:
+                self.read_pool = await asyncpg.create_pool(
+                    self.read_database_url,
+                    min_size=2,
+                    max_size=10,
+                    command_timeout=10,
+                    statement_cache_size=0,
+                    ssl='require' if 'localhost' not in self.read_database_url else False
+                )
+                print("✅ Pool de lectura (réplica) PostgreSQL creado")
+            else:
+                self.read_pool = self.pool
     
     async def close(self) -> None:
+        if self.read_pool and self.read_pool is not self.pool:
+            await self.read_pool.close()
         if self.pool:
             await self.pool.close()
             print("✅ Pool de conexiones cerrado")
     
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[asyncpg.Connection]:
+        """
+        Agrupa varias sentencias de escritura en una única transacción.
+        
+        asyncpg trabaja en autocommit: cada sentencia suelta ya es atómica y no
+        paga BEGIN/COMMIT. Usar esto solo cuando varias sentencias deben verse juntas.
+        
+            async with db.transaction() as conn:
+                await conn.execute(...)
+                await conn.fetchrow(...)
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                yield conn
+    
     async def initialize(self) -> None:
         await self.connect()
         
@@ -218,6 +305,17 @@ class Database:
                     CONSTRAINT unique_meal_name UNIQUE (user_id, meal_name)
                 );
                 
+                CREATE TABLE IF NOT EXISTS nutrition_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    food_name TEXT NOT NULL,
+                    calories_per_100g REAL NOT NULL,
+                    protein_per_100g REAL NOT NULL,
+                    carbs_per_100g REAL NOT NULL,
+                    fat_per_100g REAL NOT NULL,
+                    source TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                
                 CREATE INDEX IF NOT EXISTS idx_food_logs_user_time 
                     ON food_logs(user_id, timestamp);
                 CREATE INDEX IF NOT EXISTS idx_saved_meals_user 
@@ -229,34 +327,36 @@ class Database:
     # ========== USUARIOS ==========
     
     async def get_or_create_user(self, user_id: int, name: str = "Usuario") -> User:
-        async with self.pool.acquire() as conn:
+        user = self._user_cache.get(user_id)
+        if user is not None:
+            return user
+        
+        # Caso habitual: el usuario ya existe → basta una lectura
+        async with self.read_pool.acquire() as conn:
             row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-            if row:
-                return User(
-                    user_id=row['user_id'], name=row['name'],
-                    daily_calorie_goal=row['daily_calorie_goal'],
-                    daily_protein_goal=row['daily_protein_goal'],
-                    daily_carbs_goal=row['daily_carbs_goal'],
-                    daily_fat_goal=row['daily_fat_goal'],
-                    created_at=str(row['created_at'])
+        
+        if not row:
+            async with self.transaction() as conn:
+                # ON CONFLICT cubre el retraso de la réplica (el usuario ya puede existir en el primario)
+                await conn.execute(
+                    """
+                    INSERT INTO users (user_id, name, daily_calorie_goal, daily_protein_goal, daily_carbs_goal, daily_fat_goal)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                    ON CONFLICT (user_id) DO NOTHING
+                    """, user_id, name, 2500, 150, 300, 80
                 )
-            
-            await conn.execute(
-                """
-                INSERT INTO users (user_id, name, daily_calorie_goal, daily_protein_goal, daily_carbs_goal, daily_fat_goal)
-                VALUES ($1, $2, $3, $4, $5, $6)
-                """, user_id, name, 2500, 150, 300, 80
-            )
-            
-            row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-            return User(
-                user_id=row['user_id'], name=row['name'],
-                daily_calorie_goal=row['daily_calorie_goal'],
-                daily_protein_goal=row['daily_protein_goal'],
-                daily_carbs_goal=row['daily_carbs_goal'],
-                daily_fat_goal=row['daily_fat_goal'],
-                created_at=str(row['created_at'])
-            )
+                row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
+        
+        user = User(
+            user_id=row['user_id'], name=row['name'],
+            daily_calorie_goal=row['daily_calorie_goal'],
+            daily_protein_goal=row['daily_protein_goal'],
+            daily_carbs_goal=row['daily_carbs_goal'],
+            daily_fat_goal=row['daily_fat_goal'],
+            created_at=str(row['created_at'])
+        )
+        self._user_cache.set(user_id, user)
+        return user
     
     async def update_user_goals(self, user_id: int, daily_calorie_goal: int, daily_protein_goal: int, daily_carbs_goal: int, daily_fat_goal: int) -> None:
         async with self.pool.acquire() as conn:
@@ -266,93 +366,177 @@ class Database:
                 WHERE user_id = $5
                 """, daily_calorie_goal, daily_protein_goal, daily_carbs_goal, daily_fat_goal, user_id
             )
+        # Los objetivos cambiaron: la próxima lectura debe ir a la BD
+        self._user_cache.pop(user_id)
 
     # ========== REGISTRO DE ALIMENTOS ==========
     
     async def log_food(self, user_id: int, food_name: str, quantity_grams: int, calories: int, protein: int, carbs: int, fat: int, barcode: Optional[str] = None) -> int:
         async with self.pool.acquire() as conn:
-            log_id = await conn.fetchval(
+            row = await conn.fetchrow(
                 """
                 INSERT INTO food_logs (user_id, food_name, quantity_grams, calories, protein, carbs, fat, barcode)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING log_id
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING log_id, LOCALTIMESTAMP as db_now
                 """, user_id, food_name, quantity_grams, calories, protein, carbs, fat, barcode
             )
-            return log_id
+        _sync_db_clock(row['db_now'])
+        # Write-through: sumar la entrada a los totales cacheados del día
+        await cache_incr_hash(_today_totals_key(user_id, row['db_now']), {
+            "total_calories": calories, "total_protein": protein,
+            "total_carbs": carbs, "total_fat": fat, "food_count": 1
+        }, TODAY_TOTALS_TTL, _today_totals_version_key(user_id))
+        return row['log_id']
     
-    async def get_today_totals(self, user_id: int) -> Dict[str, int]:
+    async def log_foods_and_get_totals(self, user_id: int, foods: List[Tuple[str, int, int, int, int, int]]) -> Tuple[List[int], Dict[str, int]]:
+        """
+        Registra los alimentos de una comida y devuelve el total del día en UN round-trip.
+        
+        Args:
+            user_id: Usuario
+            foods: Tuplas (food_name, quantity_grams, calories, protein, carbs, fat)
+            
+        Returns:
+            (log_ids insertados, totales del día lógico actual incluyendo esta comida)
+        """
+        names, grams, calories, protein, carbs, fat = (list(col) for col in zip(*foods))
         async with self.pool.acquire() as conn:
-            day_start = get_logical_day_start()
-            day_end = get_logical_day_end()
+            # El SELECT principal no ve las filas que inserta el CTE (mismo snapshot),
+            # por eso se suman explícitamente con UNION ALL
             row = await conn.fetchrow(
-                """
-                SELECT SUM(calories)::INTEGER as total_calories, SUM(protein)::INTEGER as total_protein,
-                       SUM(carbs)::INTEGER as total_carbs, SUM(fat)::INTEGER as total_fat, COUNT(*)::INTEGER as food_count
-                FROM food_logs WHERE user_id = $1 AND timestamp >= $2 AND timestamp < $3
-                """, user_id, day_start, day_end
+                f"""
+                WITH ins AS (
+                    INSERT INTO food_logs (user_id, food_name, quantity_grams, calories, protein, carbs, fat)
+                    SELECT $1, f.food_name, f.quantity_grams, f.calories, f.protein, f.carbs, f.fat
+                    FROM unnest($2::TEXT[], $3::INTEGER[], $4::INTEGER[], $5::INTEGER[], $6::INTEGER[], $7::INTEGER[])
+                         AS f(food_name, quantity_grams, calories, protein, carbs, fat)
+                    RETURNING log_id, calories, protein, carbs, fat
+                ), day AS (
+                    SELECT calories, protein, carbs, fat FROM food_logs
+                    WHERE user_id = $1 AND timestamp >= {LOGICAL_DAY_START_SQL}
+                    UNION ALL
+                    SELECT calories, protein, carbs, fat FROM ins
+                )
+                SELECT (SELECT array_agg(log_id ORDER BY log_id) FROM ins) as log_ids, LOCALTIMESTAMP as db_now,
+                       COALESCE(SUM(calories), 0)::INTEGER as total_calories, COALESCE(SUM(protein), 0)::INTEGER as total_protein,
+                       COALESCE(SUM(carbs), 0)::INTEGER as total_carbs, COALESCE(SUM(fat), 0)::INTEGER as total_fat,
+                       COUNT(*)::INTEGER as food_count
+                FROM day
+                """, user_id, names, grams, calories, protein, carbs, fat
             )
-            if not row or row['total_calories'] is None:
-                return {"total_calories": 0, "total_protein": 0, "total_carbs": 0, "total_fat": 0, "food_count": 0}
-            return {
-                "total_calories": row['total_calories'] or 0, "total_protein": row['total_protein'] or 0,
-                "total_carbs": row['total_carbs'] or 0, "total_fat": row['total_fat'] or 0, "food_count": row['food_count'] or 0
-            }
+        totals = dict(row)
+        log_ids = totals.pop("log_ids")
+        db_now = totals.pop("db_now")
+        _sync_db_clock(db_now)
+        # Write-through con la suma de la comida. No se sustituye el hash con estos
+        # totales: otra escritura simultánea podría no estar en su snapshot
+        await cache_incr_hash(_today_totals_key(user_id, db_now), {
+            "total_calories": sum(calories), "total_protein": sum(protein),
+            "total_carbs": sum(carbs), "total_fat": sum(fat), "food_count": len(foods)
+        }, TODAY_TOTALS_TTL, _today_totals_version_key(user_id))
+        return log_ids, totals
     
-    async def get_day_history(self, user_id: int, date: datetime) -> Tuple[Dict[str, int], List[FoodLog]]:
+    async def get_today_totals(self, user_id: int) -> Dict[str, int]:
+        cached = await cache_get_hash(_today_totals_key(user_id))
+        if cached is not None:
+            return cached
+        
+        # Versión ANTES del SUM: si alguien escribe mientras tanto, no se cachea
+        version_key = _today_totals_version_key(user_id)
+        version = await cache_get_counter(version_key)
+        
+        # Pool principal a propósito: se consulta justo después de registrar/borrar
+        # y debe ver esa escritura aunque la réplica vaya con retraso
         async with self.pool.acquire() as conn:
-            day_start = get_logical_day_start(date)
-            day_end = get_logical_day_end(date)
-            summary_row = await conn.fetchrow(
-                """
-                SELECT SUM(calories)::INTEGER as total_calories, SUM(protein)::INTEGER as total_protein,
-                       SUM(carbs)::INTEGER as total_carbs, SUM(fat)::INTEGER as total_fat, COUNT(*)::INTEGER as food_count
-                FROM food_logs WHERE user_id = $1 AND timestamp >= $2 AND timestamp < $3
-                """, user_id, day_start, day_end
+            row = await conn.fetchrow(
+                f"""
+                SELECT COALESCE(SUM(calories), 0)::INTEGER as total_calories, COALESCE(SUM(protein), 0)::INTEGER as total_protein,
+                       COALESCE(SUM(carbs), 0)::INTEGER as total_carbs, COALESCE(SUM(fat), 0)::INTEGER as total_fat,
+                       COUNT(*)::INTEGER as food_count, LOCALTIMESTAMP as db_now
+                FROM food_logs WHERE user_id = $1 AND timestamp >= {LOGICAL_DAY_START_SQL}
+                """, user_id
             )
-            
-            summary = {"total_calories": 0, "total_protein": 0, "total_carbs": 0, "total_fat": 0, "food_count": 0}
-            if summary_row and summary_row['total_calories'] is not None:
-                summary = {
-                    "total_calories": summary_row['total_calories'] or 0, "total_protein": summary_row['total_protein'] or 0,
-                    "total_carbs": summary_row['total_carbs'] or 0, "total_fat": summary_row['total_fat'] or 0, "food_count": summary_row['food_count'] or 0
-                }
-            
+        # Un agregado sin GROUP BY siempre devuelve exactamente una fila
+        totals = dict(row)
+        db_now = totals.pop("db_now")
+        _sync_db_clock(db_now)
+        if version is not None:
+            # Clave del mismo día lógico que acotó el SUM
+            await cache_set_hash_if_version(
+                _today_totals_key(user_id, db_now), totals, TODAY_TOTALS_TTL, version_key, version
+            )
+        return totals
+    
+    async def get_day_history(self, user_id: int, date: datetime) -> Tuple[Dict[str, int], List[FoodLog]]:
+        day_start = get_logical_day_start(date)
+        day_end = get_logical_day_end(date)
+        async with self.read_pool.acquire() as conn:
             rows = await conn.fetch(
                 "SELECT * FROM food_logs WHERE user_id = $1 AND timestamp >= $2 AND timestamp < $3 ORDER BY timestamp DESC",
                 user_id, day_start, day_end
             )
-            food_logs = [
-                FoodLog(
-                    log_id=row['log_id'], user_id=row['user_id'], food_name=row['food_name'],
-                    quantity_grams=row['quantity_grams'], calories=row['calories'], protein=row['protein'],
-                    carbs=row['carbs'], fat=row['fat'], timestamp=str(row['timestamp']), barcode=row['barcode']
-                ) for row in rows
-            ]
-            return summary, food_logs
+        
+        # El resumen se suma sobre los mismos Records (sin segunda consulta SUM)
+        total_calories = total_protein = total_carbs = total_fat = 0
+        for row in rows:
+            total_calories += row['calories']
+            total_protein += row['protein']
+            total_carbs += row['carbs']
+            total_fat += row['fat']
+        summary = {
+            "total_calories": total_calories, "total_protein": total_protein,
+            "total_carbs": total_carbs, "total_fat": total_fat, "food_count": len(rows)
+        }
+        
+        # Construir los objetos con la conexión ya devuelta al pool
+        food_logs = [
+            FoodLog(
+                log_id=row['log_id'], user_id=row['user_id'], food_name=row['food_name'],
+                quantity_grams=row['quantity_grams'], calories=row['calories'], protein=row['protein'],
+                carbs=row['carbs'], fat=row['fat'], timestamp=str(row['timestamp']), barcode=row['barcode']
+            ) for row in rows
+        ]
+        return summary, food_logs
     
     async def delete_last_entry(self, user_id: int) -> bool:
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT log_id FROM food_logs WHERE user_id = $1 ORDER BY timestamp DESC LIMIT 1", user_id)
-            if not row:
-                return False
-            deleted = await conn.execute("DELETE FROM food_logs WHERE log_id = $1", row['log_id'])
-            return deleted != "DELETE 0"
+            # Localizar y borrar en una sola sentencia (atómica, un único round-trip)
+            deleted = await conn.fetchrow(
+                f"""
+                DELETE FROM food_logs WHERE log_id = (
+                    SELECT log_id FROM food_logs WHERE user_id = $1 ORDER BY timestamp DESC LIMIT 1
+                )
+                RETURNING calories, protein, carbs, fat, timestamp >= {LOGICAL_DAY_START_SQL} as is_today,
+                          LOCALTIMESTAMP as db_now
+                """, user_id
+            )
+        if deleted is None:
+            return False
+        _sync_db_clock(deleted['db_now'])
+        # Solo afecta a los totales cacheados si la entrada borrada era de hoy
+        if deleted['is_today']:
+            await cache_incr_hash(_today_totals_key(user_id, deleted['db_now']), {
+                "total_calories": -deleted['calories'], "total_protein": -deleted['protein'],
+                "total_carbs": -deleted['carbs'], "total_fat": -deleted['fat'], "food_count": -1
+            }, TODAY_TOTALS_TTL, _today_totals_version_key(user_id))
+        return True
 
     # ========== PLATOS GUARDADOS ==========
     
     async def save_meal(self, user_id: int, meal_name: str, total_calories: int, total_protein: int, total_carbs: int, total_fat: int) -> int:
-        try:
-            async with self.pool.acquire() as conn:
-                return await conn.fetchval(
-                    """
-                    INSERT INTO saved_meals (user_id, meal_name, total_calories, total_protein, total_carbs, total_fat)
-                    VALUES ($1, $2, $3, $4, $5, $6) RETURNING meal_id
-                    """, user_id, meal_name, total_calories, total_protein, total_carbs, total_fat
-                )
-        except asyncpg.UniqueViolationError:
-            return -1
+        async with self.pool.acquire() as conn:
+            # Si ya existe (user_id, meal_name) no se inserta nada y RETURNING no devuelve fila
+            meal_id = await conn.fetchval(
+                """
+                INSERT INTO saved_meals (user_id, meal_name, total_calories, total_protein, total_carbs, total_fat)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (user_id, meal_name) DO NOTHING
+                RETURNING meal_id
+                """, user_id, meal_name, total_calories, total_protein, total_carbs, total_fat
+            )
+        return meal_id if meal_id is not None else -1
     
     async def get_saved_meal(self, user_id: int, meal_name: str) -> Optional[SavedMeal]:
-        async with self.pool.acquire() as conn:
+        async with self.read_pool.acquire() as conn:
             row = await conn.fetchrow("SELECT * FROM saved_meals WHERE user_id = $1 AND meal_name = $2", user_id, meal_name)
             if not row: return None
             return SavedMeal(
@@ -361,20 +545,62 @@ class Database:
             )
     
     async def list_saved_meals(self, user_id: int) -> List[SavedMeal]:
-        async with self.pool.acquire() as conn:
+        async with self.read_pool.acquire() as conn:
             rows = await conn.fetch("SELECT * FROM saved_meals WHERE user_id = $1 ORDER BY meal_name", user_id)
-            return [
-                SavedMeal(
-                    meal_id=row['meal_id'], user_id=row['user_id'], meal_name=row['meal_name'], total_calories=row['total_calories'],
-                    total_protein=row['total_protein'], total_carbs=row['total_carbs'], total_fat=row['total_fat'], created_at=str(row['created_at'])
-                ) for row in rows
-            ]
+        
+        return [
+            SavedMeal(
+                meal_id=row['meal_id'], user_id=row['user_id'], meal_name=row['meal_name'], total_calories=row['total_calories'],
+                total_protein=row['total_protein'], total_carbs=row['total_carbs'], total_fat=row['total_fat'], created_at=str(row['created_at'])
+            ) for row in rows
+        ]
     
     async def delete_saved_meal(self, user_id: int, meal_name: str) -> bool:
         async with self.pool.acquire() as conn:
             result = await conn.execute("DELETE FROM saved_meals WHERE user_id = $1 AND meal_name = $2", user_id, meal_name)
             return result != "DELETE 0"
 
+
+    # ========== CACHÉ NUTRICIONAL PERSISTENTE ==========
+    # Resultados de OFF/USDA que sobreviven a reinicios y despliegues (la L1 se
+    # vacía y Redis es opcional). Se guarda el formato de NutritionalData.to_dict()
+    
+    async def get_cached_nutrition(self, cache_key: str, max_age_seconds: int) -> Optional[Dict]:
+        async with self.read_pool.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                SELECT food_name, calories_per_100g, protein_per_100g, carbs_per_100g, fat_per_100g, source
+                FROM nutrition_cache
+                WHERE cache_key = $1 AND updated_at > CURRENT_TIMESTAMP - make_interval(secs => $2)
+                """,
+                cache_key, float(max_age_seconds)
+            )
+        return dict(row) if row else None
+    
+    async def set_cached_nutrition_many(self, entries: List[Tuple[str, Dict]]) -> None:
+        """Guarda (o refresca) varias entradas (cache_key, datos) en una sola ida y vuelta."""
+        async with self.pool.acquire() as conn:
+            await conn.executemany(
+                """
+                INSERT INTO nutrition_cache
+                    (cache_key, food_name, calories_per_100g, protein_per_100g, carbs_per_100g, fat_per_100g, source)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    food_name = EXCLUDED.food_name,
+                    calories_per_100g = EXCLUDED.calories_per_100g,
+                    protein_per_100g = EXCLUDED.protein_per_100g,
+                    carbs_per_100g = EXCLUDED.carbs_per_100g,
+                    fat_per_100g = EXCLUDED.fat_per_100g,
+                    source = EXCLUDED.source,
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                [
+                    (key, d["food_name"], d["calories_per_100g"], d["protein_per_100g"],
+                     d["carbs_per_100g"], d["fat_per_100g"], d["source"])
+                    for key, d in entries
+                ]
+            )
+
 # ==========================================
 # INSTANCIA GLOBAL
 # ==========================================
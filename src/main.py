@@ -23,11 +23,15 @@ FSM STATES:
 
 import asyncio
 import os
+import re
+from html import escape
 from aiohttp import web
 from datetime import datetime
 from aiogram import Dispatcher, Router, F, Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
 from aiogram.types import Message, PhotoSize, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -35,6 +39,7 @@ import logging
 
 from src.config import TELEGRAM_BOT_TOKEN
 from src.database.db import db
+from src.cache import close_cache
 from src.services.api_services import (
     process_with_gemini,
     process_gemini_and_enrich,
@@ -43,8 +48,11 @@ from src.services.api_services import (
     extract_barcode_from_image,
     analyze_food_plate_with_groq,
     _analyze_nutrition_label_with_groq,
-    NutritionalData,
+    get_http_session,
+    close_api_clients,
+    flush_persistent_cache,
 )
+from src.services.common_foods import match_common_foods
 
 
 # ==========================================
@@ -90,6 +98,85 @@ fsm_router = Router()
 # HELPERS / FUNCIONES AUXILIARES
 # ==========================================
 
+# Cantidad en gramos: "150", "150g", "150 gr", "150 gramos", "150grams"
+_QTY_RE = re.compile(r'^\s*(\d+)\s*(?:g|gr|gram|grams|gramos)?\s*$', re.IGNORECASE)
+
+
+_SUMMARY_TMPL_WITH_GOALS = """
+📊 <b>RESUMEN NUTRICIONAL DEL DÍA</b>
+
+🔥 Calorías: <b>{total_calories}</b> kcal / {goal_cal} kcal ({pct}%)
+🥩 Proteína: <b>{total_protein}</b> g / {goal_prot}g
+🍞 Carbohidratos: <b>{total_carbs}</b> g / {goal_carbs}g
+🧈 Grasas: <b>{total_fat}</b> g / {goal_fat}g
+📈 Comidas registradas: <b>{food_count}</b>
+"""
+
+_SUMMARY_TMPL_NO_GOALS = """
+📊 <b>RESUMEN NUTRICIONAL DEL DÍA</b>
+
+🔥 Calorías: <b>{total_calories}</b> kcal
+🥩 Proteína: <b>{total_protein}</b> g
+🍞 Carbohidratos: <b>{total_carbs}</b> g
+🧈 Grasas: <b>{total_fat}</b> g
+📈 Comidas registradas: <b>{food_count}</b>
+"""
+
+
+_SEPARATOR = "=" * 50
+
+_SUBTOTAL_TMPL = (
+    f"\n{_SEPARATOR}\n"
+    "📊 <b>Subtotal añadido</b>\n"
+    "🔥 {calories} kcal\n"
+    "🥩 {protein}g proteína\n"
+    "🍞 {carbs}g carbohidratos\n"
+    "🧈 {fat}g grasas\n"
+)
+
+
+# Variante de una línea para la respuesta a fotos
+_SUBTOTAL_INLINE_TMPL = (
+    f"\n{_SEPARATOR}\n"
+    "📊 <b>Subtotal añadido</b>\n"
+    "🔥 {calories} kcal | 🥩 {protein}g | 🍞 {carbs}g | 🧈 {fat}g\n"
+)
+
+# Totales del día en el mensaje de texto: bloque compacto, sin objetivos
+_TODAY_TOTAL_TMPL = (
+    f"\n{_SEPARATOR}\n"
+    "📈 <b>Hoy total:</b>\n"
+    "🔥 {total_calories} kcal\n"
+    "🥩 {total_protein}g proteína\n"
+    "🍞 {total_carbs}g carbohidratos\n"
+    "🧈 {total_fat}g grasas\n"
+)
+
+
+def _format_subtotal(totals: dict, inline: bool = False) -> str:
+    """Bloque 'Subtotal añadido' a partir de un dict calories/protein/carbs/fat."""
+    return (_SUBTOTAL_INLINE_TMPL if inline else _SUBTOTAL_TMPL).format_map(totals)
+
+
+def _compute_meal_rows(enriched_foods) -> tuple:
+    """
+    Calcula los totales de cada alimento una sola vez.
+    
+    Returns:
+        (filas (food_name, grams, calories, protein, carbs, fat) listas para
+         log_foods_and_get_totals, dict subtotal calories/protein/carbs/fat)
+    """
+    rows = []
+    for food_name, grams, nutrition in enriched_foods:
+        totals = nutrition.calculate_totals(grams)
+        rows.append((food_name, grams, totals["calories"], totals["protein"], totals["carbs"], totals["fat"]))
+    
+    # Transponer filas → columnas y sumar cada macro de una pasada
+    _, _, calories, protein, carbs, fat = zip(*rows)
+    subtotal = {"calories": sum(calories), "protein": sum(protein), "carbs": sum(carbs), "fat": sum(fat)}
+    return rows, subtotal
+
+
 def format_nutrition_summary(totals: dict, user=None) -> str:
     """
     Formatea el resumen de nutrición para mostrar al usuario.
@@ -101,45 +188,19 @@ def format_nutrition_summary(totals: dict, user=None) -> str:
     Returns:
         Texto formateado bonito
     """
+    # get_today_totals / log_foods_and_get_totals siempre devuelven todas las claves
+    if user is None:
+        return _SUMMARY_TMPL_NO_GOALS.format_map(totals)
     
-    cals = totals.get("total_calories", 0)
-    prot = totals.get("total_protein", 0)
-    carbs = totals.get("total_carbs", 0)
-    fat = totals.get("total_fat", 0)
-    
-    message = f"""
-📊 **RESUMEN NUTRICIONAL DEL DÍA**
-
-🔥 Calorías: **{cals}** kcal"""
-    
-    if user:
-        goal = user.daily_calorie_goal
-        percentage = int((cals / goal) * 100) if goal > 0 else 0
-        message += f" / {goal} kcal ({percentage}%)"
-    
-    message += f"""
-🥩 Proteína: **{prot}** g"""
-    
-    if user:
-        message += f" / {user.daily_protein_goal}g"
-    
-    message += f"""
-🍞 Carbohidratos: **{carbs}** g"""
-    
-    if user:
-        message += f" / {user.daily_carbs_goal}g"
-    
-    message += f"""
-🧈 Grasas: **{fat}** g"""
-    
-    if user:
-        message += f" / {user.daily_fat_goal}g"
-    
-    message += f"""
-📈 Comidas registradas: **{totals.get('food_count', 0)}**
-"""
-    
-    return message
+    goal = user.daily_calorie_goal
+    return _SUMMARY_TMPL_WITH_GOALS.format_map({
+        **totals,
+        "goal_cal": goal,
+        "pct": totals["total_calories"] * 100 // goal if goal > 0 else 0,
+        "goal_prot": user.daily_protein_goal,
+        "goal_carbs": user.daily_carbs_goal,
+        "goal_fat": user.daily_fat_goal,
+    })
 
 
 def format_food_list(food_logs) -> str:
@@ -147,12 +208,12 @@ def format_food_list(food_logs) -> str:
     if not food_logs:
         return "No hay registros para este día."
     
-    message = "**Desglose de consumo:**\n\n"
+    parts = ["<b>Desglose de consumo:</b>\n\n"]
     
     for log in food_logs:
-        time = datetime.fromisoformat(log.timestamp).strftime("%H:%M")
-        message += (
-            f"⏰ {time} - {log.food_name}\n"
+        time = log.timestamp[11:16]  # "YYYY-MM-DD HH:MM:SS" → "HH:MM"
+        parts.append(
+            f"⏰ {time} - {escape(log.food_name)}\n"
             f"   {log.quantity_grams}g → "
             f"{log.calories} kcal | "
             f"P: {log.protein}g | "
@@ -160,7 +221,7 @@ def format_food_list(food_logs) -> str:
             f"G: {log.fat}g\n\n"
         )
     
-    return message
+    return "".join(parts)
 
 
 # ==========================================
@@ -174,7 +235,8 @@ async def handle_text_or_barcode(message: Message, state: FSMContext) -> None:
     
     FLUJO:
     1. ¿Es un código de barras numérico? → Open Food Facts → Solicitar cantidad (FSM)
-    2. ¿Es texto normal? → Gemini → Procesar alimentos
+    2. ¿Son alimentos comunes conocidos? → Tabla local (sin LLM)
+    3. ¿Es texto normal? → Gemini → Procesar alimentos
     """
     
     user_id = message.from_user.id
@@ -192,7 +254,7 @@ async def handle_text_or_barcode(message: Message, state: FSMContext) -> None:
             if nutrition_data:
                 # Código encontrado en Open Food Facts
                 await message.reply(
-                    f"✅ Producto encontrado: **{nutrition_data.food_name}**\n\n"
+                    f"✅ Producto encontrado: <b>{escape(nutrition_data.food_name)}</b>\n\n"
                     f"Valores por 100g:\n"
                     f"🔥 {nutrition_data.calories_per_100g} kcal\n"
                     f"🥩 {nutrition_data.protein_per_100g}g proteína\n"
@@ -203,10 +265,7 @@ async def handle_text_or_barcode(message: Message, state: FSMContext) -> None:
                 
                 # Guardar en contexto FSM
                 await state.set_state(NutritionFSM.waiting_quantity)
-                await state.update_data(
-                    nutrition_data=nutrition_data.to_dict(),
-                    barcode=text
-                )
+                await state.update_data(nutrition=nutrition_data, barcode=text)
                 return
             else:
                 await message.reply(
@@ -215,18 +274,22 @@ async def handle_text_or_barcode(message: Message, state: FSMContext) -> None:
                 )
                 return
         
-        # ========== INTENTO 2: PROCESAR CON GEMINI ==========
-        gemini_result = await process_with_gemini(text)
+        # ========== INTENTO 2: ALIMENTOS COMUNES (tabla local, sin LLM) ==========
+        enriched_foods = match_common_foods(text)
         
-        if not gemini_result:
-            await message.reply(
-                "⚠️ No pude procesar tu mensaje. "
-                "Intenta ser más específico (ej: 'Arroz con pollo')"
-            )
-            return
-        
-        # Enriquecer datos
-        enriched_foods = await process_gemini_and_enrich(gemini_result)
+        # ========== INTENTO 3: PROCESAR CON GEMINI ==========
+        if enriched_foods is None:
+            gemini_result = await process_with_gemini(text)
+            
+            if not gemini_result:
+                await message.reply(
+                    "⚠️ No pude procesar tu mensaje. "
+                    "Intenta ser más específico (ej: 'Arroz con pollo')"
+                )
+                return
+            
+            # Enriquecer datos
+            enriched_foods = await process_gemini_and_enrich(gemini_result)
         
         if not enriched_foods:
             await message.reply("❌ No se encontraron alimentos a procesar.")
@@ -235,63 +298,34 @@ async def handle_text_or_barcode(message: Message, state: FSMContext) -> None:
         # Registrar usuario si no existe
         user = await db.get_or_create_user(user_id, message.from_user.first_name)
         
-        # Registrar cada alimento en la BD
-        total_calories = 0
-        total_protein = 0
-        total_carbs = 0
-        total_fat = 0
+        # Calcular los totales de cada alimento una sola vez
+        rows, subtotal = _compute_meal_rows(enriched_foods)
         
-        response_message = "✅ **Alimentos registrados:**\n\n"
+        # Registrar todos los alimentos y obtener el total del día en un único round-trip
+        _, today_totals = await db.log_foods_and_get_totals(user_id, rows)
         
-        for food_name, grams, nutrition in enriched_foods:
-            totals = nutrition.calculate_totals(grams)
-            
-            log_id = await db.log_food(
-                user_id=user_id,
-                food_name=food_name,
-                quantity_grams=grams,
-                calories=totals["calories"],
-                protein=totals["protein"],
-                carbs=totals["carbs"],
-                fat=totals["fat"],
-            )
-            
-            # Acumular totales
-            total_calories += totals["calories"]
-            total_protein += totals["protein"]
-            total_carbs += totals["carbs"]
-            total_fat += totals["fat"]
-            
-            # Construir respuesta
-            response_message += (
-                f"🍽️ {food_name}\n"
-                f"   {grams}g → {totals['calories']} kcal | "
-                f"P:{totals['protein']}g C:{totals['carbs']}g G:{totals['fat']}g\n"
+        # Construir respuesta por partes y unir una sola vez al final
+        parts = ["✅ <b>Alimentos registrados:</b>\n\n"]
+        
+        for food_name, grams, calories, protein, carbs, fat in rows:
+            parts.append(
+                f"🍽️ {escape(food_name)}\n"
+                f"   {grams}g → {calories} kcal | "
+                f"P:{protein}g C:{carbs}g G:{fat}g\n"
             )
         
         # Agregar resumen
-        response_message += f"\n{'='*50}\n"
-        response_message += f"📊 **Subtotal añadido**\n"
-        response_message += f"🔥 {total_calories} kcal\n"
-        response_message += f"🥩 {total_protein}g proteína\n"
-        response_message += f"🍞 {total_carbs}g carbohidratos\n"
-        response_message += f"🧈 {total_fat}g grasas\n"
-        
-        # Obtener resumen del día
-        today_totals = await db.get_today_totals(user_id)
-        response_message += f"\n{'='*50}\n"
-        response_message += f"📈 **Hoy total:**\n"
-        response_message += f"🔥 {today_totals['total_calories']} kcal\n"
-        response_message += f"🥩 {today_totals['total_protein']}g proteína\n"
-        response_message += f"🍞 {today_totals['total_carbs']}g carbohidratos\n"
-        response_message += f"🧈 {today_totals['total_fat']}g grasas\n"
-        
-        await message.reply(response_message, parse_mode="Markdown")
+        parts.append(_format_subtotal(subtotal))
+        
+        # Resumen del día
+        parts.append(_TODAY_TOTAL_TMPL.format_map(today_totals))
+        
+        await message.answer("".join(parts))
         
     except Exception as e:
         logger.error(f"Error en handle_text_or_barcode: {str(e)}")
         await message.reply(
-            f"❌ Ocurrió un error: {str(e)}\n"
+            f"❌ Ocurrió un error: {escape(str(e))}\n"
             "Por favor, intenta de nuevo."
         )
 
@@ -324,11 +358,9 @@ async def handle_photo(message: Message, state: FSMContext) -> None:
         # PASO 1: Descargar foto
         photo: PhotoSize = message.photo[-1]  # Última es la más grande
         
-        import io
-        file = await message.bot.get_file(photo.file_id)
-        image_buffer = io.BytesIO()
-        await message.bot.download_file(file.file_path, destination=image_buffer)
-        image_bytes = image_buffer.getvalue()
+        # bot.download resuelve el file_path y devuelve un BytesIO ya relleno;
+        # getvalue() comparte su buffer interno en lugar de copiarlo
+        image_bytes = (await message.bot.download(photo)).getvalue()
         
         print("🔍 Intentando detectar código de barras en la imagen...")
         
@@ -348,18 +380,17 @@ async def handle_photo(message: Message, state: FSMContext) -> None:
                 # ¡Encontrado! Pedir cantidad
                 print(f"✅ Producto encontrado: {nutrition.food_name}")
                 await state.set_state(NutritionFSM.waiting_quantity)
-                await state.update_data(nutrition_data=nutrition.to_dict(), barcode=detected_barcode)
+                await state.update_data(nutrition=nutrition, barcode=detected_barcode)
                 
                 await message.reply(
                     f"✅ <b>Producto identificado:</b>\n\n"
-                    f"📦 <b>{nutrition.food_name}</b>\n\n"
+                    f"📦 <b>{escape(nutrition.food_name)}</b>\n\n"
                     f"<b>Valores nutricionales por 100g:</b>\n"
                     f"🔥 {nutrition.calories_per_100g} kcal\n"
                     f"🥩 {nutrition.protein_per_100g}g proteína\n"
                     f"🍞 {nutrition.carbs_per_100g}g carbohidratos\n"
                     f"🧈 {nutrition.fat_per_100g}g grasas\n\n"
-                    f"<b>¿Cuántos gramos consumiste?</b> (ej: 150)",
-                    parse_mode="HTML"
+                    f"<b>¿Cuántos gramos consumiste?</b> (ej: 150)"
                 )
                 return
             else:
@@ -393,20 +424,19 @@ async def handle_photo(message: Message, state: FSMContext) -> None:
                 # Groq logró identificar el producto/plato
                 print(f"✅ Groq identificó: {groq_result.food_name}")
                 await state.set_state(NutritionFSM.waiting_quantity)
-                await state.update_data(nutrition_data=groq_result.to_dict())
+                await state.update_data(nutrition=groq_result)
                 
                 source_label = "Análisis de plato" if groq_result.source == "groq_plate_analysis" else "Lectura de etiqueta"
                 
                 await message.reply(
                     f"📸 <b>Comida identificada por IA ({source_label}):</b>\n\n"
-                    f"🍽️ <b>{groq_result.food_name}</b>\n\n"
+                    f"🍽️ <b>{escape(groq_result.food_name)}</b>\n\n"
                     f"<b>Valores nutricionales estimados por 100g:</b>\n"
                     f"🔥 {groq_result.calories_per_100g} kcal\n"
                     f"🥩 {groq_result.protein_per_100g}g proteína\n"
                     f"🍞 {groq_result.carbs_per_100g}g carbohidratos\n"
                     f"🧈 {groq_result.fat_per_100g}g grasas\n\n"
-                    f"<b>¿Cuántos gramos consumiste?</b> (ej: 300)",
-                    parse_mode="HTML"
+                    f"<b>¿Cuántos gramos consumiste?</b> (ej: 300)"
                 )
                 return
             
@@ -418,8 +448,7 @@ async def handle_photo(message: Message, state: FSMContext) -> None:
                 "• <code>Lasaña, aproximadamente 300g</code>\n"
                 "• <code>Pollo frito con arroz y ensalada</code>\n"
                 "• <code>Yogur natural, marca Danone, 150g</code>\n\n"
-                "Cuanto más detalle, más precisos serán los macros 📊",
-                parse_mode="HTML"
+                "Cuanto más detalle, más precisos serán los macros 📊"
             )
             return
         
@@ -446,54 +475,29 @@ async def handle_photo(message: Message, state: FSMContext) -> None:
         # PASO 6: Registrar usuario
         user = await db.get_or_create_user(user_id, message.from_user.first_name)
         
-        # PASO 7: Registrar alimentos
-        total_calories = 0
-        total_protein = 0
-        total_carbs = 0
-        total_fat = 0
+        # PASO 7: Registrar alimentos + total del día (un único round-trip)
+        rows, subtotal = _compute_meal_rows(enriched_foods)
+        _, today_totals = await db.log_foods_and_get_totals(user_id, rows)
         
-        response_message = "✅ <b>Alimentos detectados en la foto:</b>\n\n"
+        parts = ["✅ <b>Alimentos detectados en la foto:</b>\n\n"]
         
-        for food_name, grams, nutrition in enriched_foods:
-            totals = nutrition.calculate_totals(grams)
-            
-            await db.log_food(
-                user_id=user_id,
-                food_name=food_name,
-                quantity_grams=grams,
-                calories=totals["calories"],
-                protein=totals["protein"],
-                carbs=totals["carbs"],
-                fat=totals["fat"],
-            )
-            
-            total_calories += totals["calories"]
-            total_protein += totals["protein"]
-            total_carbs += totals["carbs"]
-            total_fat += totals["fat"]
-            
-            response_message += (
-                f"🍽️ {food_name}\n"
-                f"   {grams}g → {totals['calories']} kcal | "
-                f"P:{totals['protein']}g C:{totals['carbs']}g G:{totals['fat']}g\n"
+        for food_name, grams, calories, protein, carbs, fat in rows:
+            parts.append(
+                f"🍽️ {escape(food_name)}\n"
+                f"   {grams}g → {calories} kcal | "
+                f"P:{protein}g C:{carbs}g G:{fat}g\n"
             )
         
-        response_message += f"\n{'='*50}\n"
-        response_message += f"📊 <b>Subtotal añadido</b>\n"
-        response_message += f"🔥 {total_calories} kcal | "
-        response_message += f"🥩 {total_protein}g | "
-        response_message += f"🍞 {total_carbs}g | "
-        response_message += f"🧈 {total_fat}g\n"
+        parts.append(_format_subtotal(subtotal, inline=True))
         
-        today_totals = await db.get_today_totals(user_id)
-        response_message += f"\n{'='*50}\n"
-        response_message += format_nutrition_summary(today_totals, user)
+        parts.append(f"\n{_SEPARATOR}\n")
+        parts.append(format_nutrition_summary(today_totals, user))
         
-        await message.reply(response_message, parse_mode="HTML")
+        await message.answer("".join(parts))
         
     except Exception as e:
         logger.error(f"Error en handle_photo: {str(e)}")
-        await message.reply(f"❌ Error procesando foto: {str(e)}")
+        await message.reply(f"❌ Error procesando foto: {escape(str(e))}")
 
 
 # ==========================================
@@ -523,25 +527,9 @@ async def handle_barcode_quantity(message: Message, state: FSMContext) -> None:
     text = message.text.strip()
     
     try:
-        # Parseador más flexible - acepta "150", "150gr", "150 gr", "150g", "150 gramos"
-        # Limpiar sufijos comunes de cantidad (orden: más largo primero)
-        cleaned_text = text.lower().strip()
-        for suffix in ["gramos", "grams", "gram", "gr", "g", " "]:
-            cleaned_text = cleaned_text.replace(suffix, "").strip()
-        
-        # Intentar convertir a int
-        try:
-            grams = int(cleaned_text)
-            if grams <= 0:
-                await message.reply(
-                    "❌ Por favor, introduce una cantidad positiva.\n\n"
-                    "Válido: <code>150</code>, <code>150gr</code>, <code>150 g</code>"
-                )
-                return
-            if grams > 10000:
-                await message.reply("⚠️ Esa cantidad parece muy grande. ¿Estás seguro?")
-                return
-        except ValueError:
+        # Parseador flexible - acepta "150", "150gr", "150 gr", "150g", "150 gramos"
+        match = _QTY_RE.match(text)
+        if not match:
             await message.reply(
                 "❌ No entiendo esa cantidad.\n\n"
                 "Por favor, introduce un número:\n"
@@ -549,27 +537,28 @@ async def handle_barcode_quantity(message: Message, state: FSMContext) -> None:
             )
             return
         
-        # Recuperar datos del contexto
+        grams = int(match.group(1))
+        if grams <= 0:
+            await message.reply(
+                "❌ Por favor, introduce una cantidad positiva.\n\n"
+                "Válido: <code>150</code>, <code>150gr</code>, <code>150 g</code>"
+            )
+            return
+        if grams > 10000:
+            await message.reply("⚠️ Esa cantidad parece muy grande. ¿Estás seguro?")
+            return
+        
+        # Recuperar datos del contexto. MemoryStorage guarda el objeto tal cual:
+        # no hace falta serializarlo a dict y reconstruirlo
         data = await state.get_data()
-        nutrition_dict = data.get("nutrition_data")
+        nutrition = data.get("nutrition")
         barcode = data.get("barcode")
         
-        if not nutrition_dict:
+        if nutrition is None:
             await message.reply("❌ Contexto perdido. Intenta scanear el código nuevamente.")
             await state.clear()
             return
         
-        # Reconstruir NutritionalData
-        from src.services.api_services import NutritionalData
-        nutrition = NutritionalData(
-            food_name=nutrition_dict["food_name"],
-            calories_per_100g=nutrition_dict["calories_per_100g"],
-            protein_per_100g=nutrition_dict["protein_per_100g"],
-            carbs_per_100g=nutrition_dict["carbs_per_100g"],
-            fat_per_100g=nutrition_dict["fat_per_100g"],
-            source=nutrition_dict["source"]
-        )
-        
         # Calcular totales
         totals = nutrition.calculate_totals(grams)
         
@@ -591,7 +580,7 @@ async def handle_barcode_quantity(message: Message, state: FSMContext) -> None:
         # Mostrar confirmación
         response = (
             f"✅ <b>Registrado:</b>\n\n"
-            f"🍽️ {nutrition.food_name}\n"
+            f"🍽️ {escape(nutrition.food_name)}\n"
             f"{grams}g → "
             f"{totals['calories']} kcal | "
             f"P:{totals['protein']}g | "
@@ -603,14 +592,14 @@ async def handle_barcode_quantity(message: Message, state: FSMContext) -> None:
         day_totals = await db.get_today_totals(user_id)
         response += format_nutrition_summary(day_totals, user)
         
-        await message.reply(response, parse_mode="HTML")
+        await message.answer(response)
         
         # Limpiar estado
         await state.clear()
         
     except Exception as e:
         logger.error(f"Error en handle_barcode_quantity: {str(e)}")
-        await message.reply(f"❌ Error: {str(e)}")
+        await message.reply(f"❌ Error: {escape(str(e))}")
         await state.clear()
 
 
@@ -618,12 +607,9 @@ async def handle_barcode_quantity(message: Message, state: FSMContext) -> None:
 # HANDLERS - COMANDOS
 # ==========================================
 
-@commands_router.message(Command("start"))
-async def cmd_start(message: Message) -> None:
-    """Comando /start - Bienvenida e instrucciones."""
-    
-    help_text = """
-👋 **¡Bienvenido al Asistente Nutricional!**
+# Textos estáticos de /start y /ayuda: se construyen una sola vez al importar
+_START_TEXT = """
+👋 <b>¡Bienvenido al Asistente Nutricional!</b>
 
 Soy tu bot de tracking de nutrición. Puedo ayudarte a:
 ✅ Registrar alimentos por foto o descripción
@@ -632,13 +618,13 @@ Soy tu bot de tracking de nutrición. Puedo ayudarte a:
 ✅ Guardar platos favoritos
 ✅ Ver historiales de días pasados
 
-**Cómo usarme:**
+<b>Cómo usarme:</b>
 
-📝 **Envía texto:** "Desayuno: tostadas con queso y café"
-📸 **Envía foto:** Sube una foto de tu plato
-📱 **Código de barras:** Escanea un código EAN
+📝 <b>Envía texto:</b> "Desayuno: tostadas con queso y café"
+📸 <b>Envía foto:</b> Sube una foto de tu plato
+📱 <b>Código de barras:</b> Escanea un código EAN
 
-**Comandos disponibles:**
+<b>Comandos disponibles:</b>
 /estado - Ver resumen nutricional de hoy
 /historial YYYY-MM-DD - Consultar un día específico
 /guardar_plato [nombre] - Guardar última comida como plato
@@ -648,9 +634,51 @@ Soy tu bot de tracking de nutrición. Puedo ayudarte a:
 /ayuda - Mostrar esta ayuda
 
 ¡Comencemos! Escribe algo o envía una foto 📸
-    """
-    
-    await message.reply(help_text, parse_mode="Markdown")
+"""
+
+_HELP_TEXT = """
+📚 <b>GUÍA COMPLETA DE USO</b>
+
+<b>Registrando alimentos:</b>
+━━━━━━━━━━━━━━━━━━━━━
+1️⃣ Envía un mensaje: "Desayuno: huevo, tostadas, café"
+2️⃣ Envía una foto: Foto de tu plato
+3️⃣ Escanea código: Tu app de cámara lo captura como texto
+
+<b>Comandos principales:</b>
+━━━━━━━━━━━━━━━━━━━━━
+/estado          - Ver macros del día actual
+/historial DD    - Ver día específico (YYYY-MM-DD)
+/guardar_plato   - Guardar última comida
+/comer_plato     - Consumir plato guardado
+/miaplatos       - Ver platos guardados
+/deshacer        - Eliminar última entrada
+
+<b>Ejemplos:</b>
+━━━━━━━━━━━━━━━━━━━━━
+💬 "Almuerzo: arroz, pollo y ensalada"
+📸 [Envía foto de comida]
+📱 [Escanea código de barras]
+/historial 2024-02-15
+/guardar_plato Mi almuerzo típico
+/comer_plato Mi almuerzo típico
+
+<b>Cómo funciona:</b>
+━━━━━━━━━━━━━━━━━━━━━
+• Google Gemini analiza fotos y descripciones
+• Busca datos en Open Food Facts y USDA FoodData Central
+• Los códigos de barras se verifican directamente
+• Todo se guarda en una base de datos local
+• El "día" comienza a las 03:00 AM
+
+¿Preguntas? Intenta: /ayuda
+"""
+
+
+@commands_router.message(Command("start"))
+async def cmd_start(message: Message) -> None:
+    """Comando /start - Bienvenida e instrucciones."""
+    await message.answer(_START_TEXT)
 
 
 @commands_router.message(Command("estado"))
@@ -665,40 +693,36 @@ async def cmd_estado(message: Message) -> None:
         
         response = format_nutrition_summary(totals, user)
         
-        await message.reply(response, parse_mode="Markdown")
+        await message.answer(response)
         
     except Exception as e:
         logger.error(f"Error en /estado: {str(e)}")
-        await message.reply(f"❌ Error: {str(e)}")
+        await message.reply(f"❌ Error: {escape(str(e))}")
 
 
 @commands_router.message(Command("historial"))
-async def cmd_historial(message: Message) -> None:
+async def cmd_historial(message: Message, command: CommandObject) -> None:
     """
     Comando /historial YYYY-MM-DD
     Muestra el registro detallado de un día específico.
     """
     
     user_id = message.from_user.id
-    text = message.text.strip()
+    # aiogram ya separó el comando de sus argumentos
+    date_str = (command.args or "").strip()
     
-    # Parsear fecha del comando
-    parts = text.split()
-    
-    if len(parts) < 2:
+    if not date_str:
         await message.reply(
             "Uso: /historial YYYY-MM-DD\n"
             "Ejemplo: /historial 2024-01-15"
         )
         return
     
-    date_str = parts[1]
-    
     try:
         target_date = datetime.strptime(date_str, "%Y-%m-%d")
     except ValueError:
         await message.reply(
-            f"❌ Formato de fecha inválido: {date_str}\n"
+            f"❌ Formato de fecha inválido: {escape(date_str)}\n"
             "Usa YYYY-MM-DD (ej: 2024-01-15)"
         )
         return
@@ -707,43 +731,39 @@ async def cmd_historial(message: Message) -> None:
         user = await db.get_or_create_user(user_id, message.from_user.first_name)
         summary, food_logs = await db.get_day_history(user_id, target_date)
         
-        response = f"📅 **Historial del {date_str}**\n\n"
-        response += f"🔥 Calorías: {summary.get('total_calories', 0)} kcal\n"
-        response += f"🥩 Proteína: {summary.get('total_protein', 0)}g\n"
-        response += f"🍞 Carbohidratos: {summary.get('total_carbs', 0)}g\n"
-        response += f"🧈 Grasas: {summary.get('total_fat', 0)}g\n\n"
-        
-        response += format_food_list(food_logs)
+        response = (
+            f"📅 <b>Historial del {escape(date_str)}</b>\n\n"
+            f"🔥 Calorías: {summary.get('total_calories', 0)} kcal\n"
+            f"🥩 Proteína: {summary.get('total_protein', 0)}g\n"
+            f"🍞 Carbohidratos: {summary.get('total_carbs', 0)}g\n"
+            f"🧈 Grasas: {summary.get('total_fat', 0)}g\n\n"
+            f"{format_food_list(food_logs)}"
+        )
         
-        await message.reply(response, parse_mode="Markdown")
+        await message.answer(response)
         
     except Exception as e:
         logger.error(f"Error en /historial: {str(e)}")
-        await message.reply(f"❌ Error: {str(e)}")
+        await message.reply(f"❌ Error: {escape(str(e))}")
 
 
 @commands_router.message(Command("guardar_plato"))
-async def cmd_save_meal(message: Message, state: FSMContext) -> None:
+async def cmd_save_meal(message: Message, command: CommandObject, state: FSMContext) -> None:
     """
     Comando /guardar_plato [nombre]
     Guarda la última comida registrada como un plato reutilizable.
     """
     
     user_id = message.from_user.id
-    text = message.text.strip()
-    
-    # Extraer nombre del plato
-    parts = text.split(maxsplit=1)
+    meal_name = (command.args or "").strip()
     
-    if len(parts) < 2:
+    if not meal_name:
         await message.reply(
             "Uso: /guardar_plato nombre\n"
             "Ejemplo: /guardar_plato Desayuno típico"
         )
         return
     
-    meal_name = parts[1]
-    
     try:
         # Obtener últimas comidas (registradas hoy)
         summary, food_logs = await db.get_day_history(user_id, datetime.now())
@@ -775,46 +795,42 @@ async def cmd_save_meal(message: Message, state: FSMContext) -> None:
         
         if meal_id == -1:
             await message.reply(
-                f"⚠️ Ya existe un plato llamado '{meal_name}'. "
+                f"⚠️ Ya existe un plato llamado '{escape(meal_name)}'. "
                 "Usa otro nombre."
             )
             return
         
-        response = f"✅ **Plato guardado: {meal_name}**\n\n"
+        response = f"✅ <b>Plato guardado: {escape(meal_name)}</b>\n\n"
         response += f"🔥 {total_calories} kcal\n"
         response += f"🥩 {total_protein}g proteína\n"
         response += f"🍞 {total_carbs}g carbohidratos\n"
         response += f"🧈 {total_fat}g grasas\n\n"
-        response += "Puedes comerlo con: /comer_plato " + meal_name
+        response += "Puedes comerlo con: /comer_plato " + escape(meal_name)
         
-        await message.reply(response, parse_mode="Markdown")
+        await message.answer(response)
         
     except Exception as e:
         logger.error(f"Error en /guardar_plato: {str(e)}")
-        await message.reply(f"❌ Error: {str(e)}")
+        await message.reply(f"❌ Error: {escape(str(e))}")
 
 
 @commands_router.message(Command("comer_plato"))
-async def cmd_eat_meal(message: Message) -> None:
+async def cmd_eat_meal(message: Message, command: CommandObject) -> None:
     """
     Comando /comer_plato [nombre]
     Consume un plato guardado (suma sus macros al registro actual).
     """
     
     user_id = message.from_user.id
-    text = message.text.strip()
-    
-    parts = text.split(maxsplit=1)
+    meal_name = (command.args or "").strip()
     
-    if len(parts) < 2:
+    if not meal_name:
         await message.reply(
             "Uso: /comer_plato nombre\n"
             "Ejemplo: /comer_plato Desayuno típico"
         )
         return
     
-    meal_name = parts[1]
-    
     try:
         user = await db.get_or_create_user(user_id, message.from_user.first_name)
         
@@ -822,7 +838,7 @@ async def cmd_eat_meal(message: Message) -> None:
         saved_meal = await db.get_saved_meal(user_id, meal_name)
         
         if not saved_meal:
-            await message.reply(f"❌ No existe plato llamado '{meal_name}'")
+            await message.reply(f"❌ No existe plato llamado '{escape(meal_name)}'")
             return
         
         # Registrar el plato como consumo
@@ -836,21 +852,22 @@ async def cmd_eat_meal(message: Message) -> None:
             fat=saved_meal.total_fat,
         )
         
-        response = f"✅ **Plato consumido: {meal_name}**\n\n"
-        response += f"🔥 {saved_meal.total_calories} kcal\n"
-        response += f"🥩 {saved_meal.total_protein}g proteína\n"
-        response += f"🍞 {saved_meal.total_carbs}g carbohidratos\n"
-        response += f"🧈 {saved_meal.total_fat}g grasas\n\n"
-        
         day_totals = await db.get_today_totals(user_id)
-        response += f"{'='*50}\n"
-        response += format_nutrition_summary(day_totals, user)
+        response = (
+            f"✅ <b>Plato consumido: {escape(meal_name)}</b>\n\n"
+            f"🔥 {saved_meal.total_calories} kcal\n"
+            f"🥩 {saved_meal.total_protein}g proteína\n"
+            f"🍞 {saved_meal.total_carbs}g carbohidratos\n"
+            f"🧈 {saved_meal.total_fat}g grasas\n\n"
+            f"{_SEPARATOR}\n"
+            f"{format_nutrition_summary(day_totals, user)}"
+        )
         
-        await message.reply(response, parse_mode="Markdown")
+        await message.answer(response)
         
     except Exception as e:
         logger.error(f"Error en /comer_plato: {str(e)}")
-        await message.reply(f"❌ Error: {str(e)}")
+        await message.reply(f"❌ Error: {escape(str(e))}")
 
 
 @commands_router.message(Command("miaplatos"))
@@ -863,25 +880,25 @@ async def cmd_my_meals(message: Message) -> None:
         meals = await db.list_saved_meals(user_id)
         
         if not meals:
-            await message.reply("📪 No tienes platos guardados aún.")
+            await message.answer("📪 No tienes platos guardados aún.")
             return
         
-        response = "🍽️ **Tus platos guardados:**\n\n"
+        parts = ["🍽️ <b>Tus platos guardados:</b>\n\n"]
         
         for meal in meals:
-            response += (
-                f"• **{meal.meal_name}**\n"
+            parts.append(
+                f"• <b>{escape(meal.meal_name)}</b>\n"
                 f"  {meal.total_calories} kcal | "
                 f"P:{meal.total_protein}g C:{meal.total_carbs}g G:{meal.total_fat}g\n\n"
             )
         
-        response += "\nUsa `/comer_plato [nombre]` para consumir uno."
+        parts.append("\nUsa <code>/comer_plato [nombre]</code> para consumir uno.")
         
-        await message.reply(response, parse_mode="Markdown")
+        await message.answer("".join(parts))
         
     except Exception as e:
         logger.error(f"Error en /miaplatos: {str(e)}")
-        await message.reply(f"❌ Error: {str(e)}")
+        await message.reply(f"❌ Error: {escape(str(e))}")
 
 
 @commands_router.message(Command("deshacer"))
@@ -894,65 +911,26 @@ async def cmd_undo(message: Message) -> None:
         success = await db.delete_last_entry(user_id)
         
         if success:
-            await message.reply("✅ Última entrada eliminada.")
+            await message.answer("✅ Última entrada eliminada.")
         else:
-            await message.reply("⚠️ No hay entradas para eliminar.")
+            await message.answer("⚠️ No hay entradas para eliminar.")
         
         # Mostrar nuevo resumen
         user = await db.get_or_create_user(user_id, message.from_user.first_name)
         totals = await db.get_today_totals(user_id)
         
         response = format_nutrition_summary(totals, user)
-        await message.reply(response, parse_mode="Markdown")
+        await message.answer(response)
         
     except Exception as e:
         logger.error(f"Error en /deshacer: {str(e)}")
-        await message.reply(f"❌ Error: {str(e)}")
+        await message.reply(f"❌ Error: {escape(str(e))}")
 
 
 @commands_router.message(Command("ayuda"))
 async def cmd_help(message: Message) -> None:
     """Comando /ayuda - Muestra instrucciones detalladas."""
-    
-    help_text = """
-📚 **GUÍA COMPLETA DE USO**
-
-**Registrando alimentos:**
-━━━━━━━━━━━━━━━━━━━━━
-1️⃣ Envía un mensaje: "Desayuno: huevo, tostadas, café"
-2️⃣ Envía una foto: Foto de tu plato
-3️⃣ Escanea código: Tu app de cámara lo captura como texto
-
-**Comandos principales:**
-━━━━━━━━━━━━━━━━━━━━━
-/estado          - Ver macros del día actual
-/historial DD    - Ver día específico (YYYY-MM-DD)
-/guardar_plato   - Guardar última comida
-/comer_plato     - Consumir plato guardado
-/miaplatos       - Ver platos guardados
-/deshacer        - Eliminar última entrada
-
-**Ejemplos:**
-━━━━━━━━━━━━━━━━━━━━━
-💬 "Almuerzo: arroz, pollo y ensalada"
-📸 [Envía foto de comida]
-📱 [Escanea código de barras]
-/historial 2024-02-15
-/guardar_plato Mi almuerzo típico
-/comer_plato Mi almuerzo típico
-
-**Cómo funciona:**
-━━━━━━━━━━━━━━━━━━━━━
-• Google Gemini analiza fotos y descripciones
-• Busca datos en Open Food Facts y USDA FoodData Central
-• Los códigos de barras se verifican directamente
-• Todo se guarda en una base de datos local
-• El "día" comienza a las 03:00 AM
-
-¿Preguntas? Intenta: /ayuda
-    """
-    
-    await message.reply(help_text, parse_mode="Markdown")
+    await message.answer(_HELP_TEXT)
 
 
 # ==========================================
@@ -1007,10 +985,14 @@ async def main():
     await db.initialize()
     logger.info("✅ Base de datos PostgreSQL inicializada")
     
+    # Sesión HTTP compartida para las APIs nutricionales
+    await get_http_session()
+    
     await start_dummy_server()
 
     # Crear bot
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    # Todos los mensajes se envían como HTML: los textos dinámicos pasan por escape()
+    bot = Bot(token=TELEGRAM_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     
     # Configurar dispatcher
     dp = await setup_dispatcher()
@@ -1022,8 +1004,11 @@ async def main():
         # Iniciar polling (escucha cambios)
         await dp.start_polling(bot)
     finally:
-        # Cerrar conexiones y pool
+        # Cerrar conexiones y pool (lo pendiente de la caché persistente, antes que la BD)
+        await flush_persistent_cache()
         await db.close()
+        await close_cache()
+        await close_api_clients()
         await bot.session.close()
 
 
@@ -9,51 +9,147 @@ ARQUITECTURA DE FLUJOS:
 
 LIBRERÍAS USADAS:
 - pyzbar: Detectar códigos de barras en imágenes (UPC, EAN, etc)
-- pytesseract: OCR fallback para leer números
 - opencv: Procesamiento avanzado de imágenes
 - groq: SDK oficial de Groq para LLaMA (gratuito, sin límites)
 - aiohttp: HTTP asíncrono
 """
 
-import json
+import asyncio
+import functools
+import hashlib
+import logging
+import random
 import re
-from typing import Dict, Optional, List, Tuple
+from typing import Callable, Dict, Optional, List, Tuple
 import aiohttp
-import requests
-from groq import Groq
-from PIL import Image
-import cv2
-import numpy as np
-from io import BytesIO
+import orjson
+from groq import AsyncGroq, RateLimitError
 import base64
 
-# Barcode detection
-try:
-    from pyzbar.pyzbar import decode as pyzbar_decode
-    PYZBAR_AVAILABLE = True
-except ImportError:
-    PYZBAR_AVAILABLE = False
-    print("⚠️ pyzbar no disponible. Instalando: pip install pyzbar")
-
-try:
-    import pytesseract
-    PYTESSERACT_AVAILABLE = True
-except ImportError:
-    PYTESSERACT_AVAILABLE = False
-    print("⚠️ pytesseract no disponible. Instalando: pip install pytesseract")
+logger = logging.getLogger(__name__)
 
 from src.config import (
     GROQ_API_KEY,
     GROQ_MODEL,
     OFF_API_ENDPOINT,
     USDA_API_ENDPOINT,
+    BARCODE_LOOKUP_API,
+    UPC_DATABASE_API,
 )
+from src.cache import TTLCache, cache_get_json, cache_set_json, cache_delete, cache_try_lock
+from src.database.db import db
+from src.services import image_processing
 
 
 # ==========================================
 # CONFIGURAR GROQ
 # ==========================================
-groq_client = Groq(api_key=GROQ_API_KEY)
+# Cliente asíncrono: la llamada al LLM (2-10 s) no bloquea el event loop.
+# Uno solo para todo el módulo: reutiliza su pool de conexiones con Groq.
+# Sin reintentos propios del SDK: los 429 los gestiona _retry_on_429
+groq_client = AsyncGroq(api_key=GROQ_API_KEY, max_retries=0)
+
+# Llamadas simultáneas a Groq en TODO el proceso. Por encima de esto Groq
+# responde 429 y cada reintento solo añade carga
+GROQ_CONCURRENCY = 4
+_GROQ_SEMAPHORE: Optional[asyncio.Semaphore] = None
+
+
+def _get_groq_semaphore() -> asyncio.Semaphore:
+    """Semáforo compartido (se crea dentro del event loop, en el primer uso)."""
+    global _GROQ_SEMAPHORE
+    if _GROQ_SEMAPHORE is None:
+        _GROQ_SEMAPHORE = asyncio.Semaphore(GROQ_CONCURRENCY)
+    return _GROQ_SEMAPHORE
+
+
+def _retry_on_429(base: float = 0.5, max_tries: int = 4):
+    """
+    Reintenta una corrutina cuando Groq responde 429 (rate limit).
+    
+    Espera exponencial con jitter completo: base·2^n como máximo, un valor
+    aleatorio por debajo para que los reintentos simultáneos no se sincronicen.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(max_tries):
+                try:
+                    return await func(*args, **kwargs)
+                except RateLimitError:
+                    if attempt == max_tries - 1:
+                        raise
+                    delay = random.uniform(0, base * 2 ** attempt)
+                    logger.warning("⏳ Groq 429, reintento %s en %.2fs", attempt + 1, delay)
+                    await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
+
+@_retry_on_429(base=0.5, max_tries=4)
+async def _groq_create(**kwargs):
+    """chat.completions.create (sin streaming) con límite de concurrencia y reintentos en 429."""
+    async with _get_groq_semaphore():
+        return await groq_client.chat.completions.create(**kwargs)
+
+
+@_retry_on_429(base=0.5, max_tries=4)
+async def _groq_open_stream(**kwargs):
+    """
+    Abre una respuesta en streaming ocupando un hueco del semáforo.
+    
+    Si la apertura falla (p. ej. 429) el hueco se devuelve antes de la espera
+    del reintento. Si no, queda ocupado: quien consume el stream debe liberarlo
+    con _get_groq_semaphore().release() al cerrarlo.
+    """
+    semaphore = _get_groq_semaphore()
+    await semaphore.acquire()
+    try:
+        return await groq_client.chat.completions.create(stream=True, **kwargs)
+    except BaseException:
+        semaphore.release()
+        raise
+
+
+# ==========================================
+# SESIÓN HTTP COMPARTIDA
+# ==========================================
+
+# Una sola sesión para todas las APIs: reutiliza conexiones keep-alive y
+# ahorra el handshake TCP+TLS (~100-300 ms) en cada consulta
+_HTTP_SESSION: Optional[aiohttp.ClientSession] = None
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """Sesión aiohttp compartida (se crea en el primer uso)."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        _HTTP_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
+            ),
+            timeout=aiohttp.ClientTimeout(total=5),
+            # OFF devuelve fichas de >50 KB: comprimidas viajan ~5x menos bytes
+            headers={"User-Agent": "nutrition-bot/1.0", "Accept-Encoding": "gzip"},
+        )
+    return _HTTP_SESSION
+
+
+async def close_http_session() -> None:
+    """Cierra la sesión compartida (al apagar el bot)."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None:
+        await _HTTP_SESSION.close()
+        _HTTP_SESSION = None
+
+
+async def close_api_clients() -> None:
+    """Cierra los clientes compartidos de APIs externas: sesión HTTP y Groq."""
+    await close_http_session()
+    await groq_client.close()
 
 
 # ==========================================
@@ -63,6 +159,12 @@ groq_client = Groq(api_key=GROQ_API_KEY)
 class NutritionalData:
     """Estructura para datos nutricionales standardizados."""
     
+    # Sin __dict__ por instancia: el historial y las cachés guardan muchas
+    __slots__ = (
+        "food_name", "calories_per_100g", "protein_per_100g",
+        "carbs_per_100g", "fat_per_100g", "source", "_per_g",
+    )
+    
     def __init__(
         self,
         food_name: str,
@@ -78,14 +180,22 @@ class NutritionalData:
         self.carbs_per_100g = carbs_per_100g
         self.fat_per_100g = fat_per_100g
         self.source = source  # "gemini", "off", "edamam"
+        # Valores por gramo precalculados (los *_per_100g no se modifican después)
+        self._per_g = (
+            calories_per_100g * 0.01,
+            protein_per_100g * 0.01,
+            carbs_per_100g * 0.01,
+            fat_per_100g * 0.01,
+        )
     
     def calculate_totals(self, quantity_grams: int) -> Dict[str, int]:
         """Calcula totales basado en cantidad."""
+        cal, prot, carbs, fat = self._per_g
         return {
-            "calories": int((self.calories_per_100g / 100) * quantity_grams),
-            "protein": int((self.protein_per_100g / 100) * quantity_grams),
-            "carbs": int((self.carbs_per_100g / 100) * quantity_grams),
-            "fat": int((self.fat_per_100g / 100) * quantity_grams),
+            "calories": int(cal * quantity_grams),
+            "protein": int(prot * quantity_grams),
+            "carbs": int(carbs * quantity_grams),
+            "fat": int(fat * quantity_grams),
         }
     
     def to_dict(self) -> Dict:
@@ -129,7 +239,10 @@ def _validate_and_fix_calories(calories_reported: float, protein_g: float, carbs
         return calories_reported
     deviation = abs(calories_reported - atwater) / atwater
     if deviation > 0.20:
-        print(f"  ⚠️ Atwater override: reportadas {calories_reported} kcal vs calculadas {atwater} kcal (desviación {deviation:.0%})")
+        logger.info(
+            "⚠️ Atwater override: reportadas %s kcal vs calculadas %s kcal (desviación %.0f%%)",
+            calories_reported, atwater, deviation * 100
+        )
         return atwater
     return calories_reported
 
@@ -142,153 +255,38 @@ async def extract_barcode_from_image(image_bytes: bytes) -> Optional[str]:
     """
     Intenta extraer código de barras EAN/UPC de una imagen.
     
-    ESTRATEGIA ALMEJORA:
-    1. pyzbar - Detección directa (RGB + Gray + Enhanced + Inverted)
-    2. Preprocesamiento agresivo (morphology, dilate, erode)
-    3. Múltiples rotaciones (0°, 90°, 180°, 270°)
+    El trabajo es CPU puro (OpenCV + pyzbar), así que se ejecuta en el pool de
+    hilos de visión para no bloquear el event loop mientras otros usuarios esperan.
     
     Retorna código detectado (ej: "8431890069843") o None.
     """
-    try:
-        img = Image.open(BytesIO(image_bytes))
-        
-        # Convertir a RGB si es necesario
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        img_array = np.array(img)
-        
-        # Intentar múltiples rotaciones y transformaciones
-        rotation_angles = [0, 90, 180, 270]
-        
-        for angle in rotation_angles:
-            # Rotar imagen si es necesario
-            if angle > 0:
-                img_rotated = Image.fromarray(img_array)
-                img_rotated = img_rotated.rotate(angle, expand=False)
-                img_array_work = np.array(img_rotated)
-            else:
-                img_array_work = img_array.copy()
-            
-            # INTENTO 1: RGB directo
-            result = _try_pyzbar_decode(img_array_work, f"RGB {angle}°")
-            if result:
-                return result
-            
-            # INTENTO 2: Escala de grises
-            try:
-                gray = cv2.cvtColor(img_array_work, cv2.COLOR_RGB2GRAY)
-                result = _try_pyzbar_decode(gray, f"Gray {angle}°")
-                if result:
-                    return result
-            except Exception as e:
-                pass
-            
-            # INTENTO 3: CLAHE Enhanced (contraste mejorado)
-            try:
-                gray = cv2.cvtColor(img_array_work, cv2.COLOR_RGB2GRAY)
-                clahe = cv2.createCLAHE(clipLimit=5.0, tileGridSize=(12, 12))
-                enhanced = clahe.apply(gray)
-                result = _try_pyzbar_decode(enhanced, f"Enhanced {angle}°")
-                if result:
-                    return result
-            except Exception as e:
-                pass
-            
-            # INTENTO 4: Inverted
-            try:
-                gray = cv2.cvtColor(img_array_work, cv2.COLOR_RGB2GRAY)
-                inverted = cv2.bitwise_not(gray)
-                result = _try_pyzbar_decode(inverted, f"Inverted {angle}°")
-                if result:
-                    return result
-            except Exception as e:
-                pass
-            
-            # INTENTO 5: Morphological operations (especial para códigos oscuros)
-            try:
-                gray = cv2.cvtColor(img_array_work, cv2.COLOR_RGB2GRAY)
-                
-                # Aplicar threshold adaptativo
-                thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                               cv2.THRESH_BINARY, 11, 2)
-                
-                # Operaciones morfológicas
-                kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-                morph = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel, iterations=1)
-                morph = cv2.morphologyEx(morph, cv2.MORPH_OPEN, kernel, iterations=1)
-                
-                result = _try_pyzbar_decode(morph, f"Morphology {angle}°")
-                if result:
-                    return result
-            except Exception as e:
-                pass
-            
-            # INTENTO 6: Normalización de histograma
-            try:
-                gray = cv2.cvtColor(img_array_work, cv2.COLOR_RGB2GRAY)
-                equalized = cv2.equalizeHist(gray)
-                result = _try_pyzbar_decode(equalized, f"Equalized {angle}°")
-                if result:
-                    return result
-            except Exception as e:
-                pass
-            
-            # INTENTO 7: Gaussian blur + threshold (para reducir ruido)
-            try:
-                gray = cv2.cvtColor(img_array_work, cv2.COLOR_RGB2GRAY)
-                blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-                _, thresh = cv2.threshold(blurred, 127, 255, cv2.THRESH_BINARY)
-                result = _try_pyzbar_decode(thresh, f"Blurred+Thresh {angle}°")
-                if result:
-                    return result
-            except Exception as e:
-                pass
-        
-        print("❌ No se detectó código de barras con ninguna estrategia")
-        return None
-        
-    except Exception as e:
-        print(f"❌ Error general en extract_barcode: {e}")
-        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        image_processing.CV_EXECUTOR, image_processing.extract_barcode_sync, image_bytes
+    )
 
 
-def _try_pyzbar_decode(img_array, strategy_name: str) -> Optional[str]:
-    """
-    Intenta decodificar código de barras con pyzbar.
-    
-    Args:
-        img_array: Array de imagen (RGB, Gray, etc)
-        strategy_name: Nombre de la estrategia (para logging)
-    
-    Returns:
-        String del código o None
-    """
-    if not PYZBAR_AVAILABLE:
-        return None
-    
-    try:
-        decoded_objects = pyzbar_decode(img_array)
-        
-        for obj in decoded_objects:
-            barcode = obj.data.decode('utf-8').strip()
-            
-            # Validar que sea código de barras válido (8-14 dígitos)
-            if barcode.isdigit() and 8 <= len(barcode) <= 14:
-                print(f"  ✅ DETECTADO {strategy_name}: {barcode}")
-                return barcode
-            elif barcode and len(barcode) > 0:
-                # Extraer secuencia de dígitos si hay otros caracteres
-                digits = re.search(r'(\d{8,14})', barcode)
-                if digits:
-                    code = digits.group(1)
-                    print(f"  ✅ DETECTADO {strategy_name} (limpiado): {code}")
-                    return code
-    
-    except Exception as e:
-        pass
-    
-    return None
+# ==========================================
+# CACHÉ DE RESPUESTAS DE GROQ
+# ==========================================
+
+# La misma descripción ("cafe con leche") se repite entre usuarios y días
+GROQ_CACHE_TTL = 7 * 24 * 3600
+# Máximo que se espera a que otro proceso termine la misma consulta
+GROQ_LOCK_TTL = 30
+GROQ_LOCK_POLL_INTERVAL = 0.5
+
+_GROQ_L1 = TTLCache(maxsize=512, ttl=600)
+# Consultas en curso en este proceso: las peticiones idénticas esperan a la primera
+_GROQ_INFLIGHT: Dict[str, "asyncio.Future"] = {}
+
+
+def _groq_cache_key(text_description: str, image_bytes: Optional[bytes]) -> str:
+    """Clave por hash del texto normalizado (y de la imagen, si la hay)."""
+    digest = hashlib.blake2b(" ".join(text_description.lower().split()).encode(), digest_size=16)
+    if image_bytes:
+        digest.update(hashlib.blake2b(image_bytes, digest_size=16).digest())
+    return f"nutri:groq:{digest.hexdigest()}:v1"
 
 
 async def process_with_gemini(
@@ -296,17 +294,76 @@ async def process_with_gemini(
     image_bytes: Optional[bytes] = None
 ) -> Optional[Dict]:
     """
-    Procesa texto y/o imagen con Groq (LLaMA).
+    Procesa texto y/o imagen con Groq (LLaMA), con caché y single-flight.
     
-    ESTRATEGIA ANTI-ALUCINACIÓN:
-    1. Groq SOLO estima macronutrientes (proteínas, carbohidratos, grasas)
-    2. PROHIBIDO que Groq calcule calorías → las calcula Python vía Atwater
-    3. Si no se especifican gramos, estima ración estándar realista
-    4. Temperatura 0.1 para máxima precisión factual
+    ORDEN: L1 (memoria, 10 min) → L2 (Redis, 7 días) → Groq.
+    - Dentro del proceso, las llamadas idénticas simultáneas comparten una sola consulta
+    - Entre procesos, un cerrojo SET NX en Redis evita que todos consulten a la vez
+    - Solo se cachean respuestas válidas (un fallo puntual de Groq no se memoriza)
     """
+    cache_key = _groq_cache_key(text_description, image_bytes)
+    
+    result = _GROQ_L1.get(cache_key)
+    if result is not None:
+        return result
+    
+    inflight = _GROQ_INFLIGHT.get(cache_key)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+    
+    future = asyncio.get_running_loop().create_future()
+    _GROQ_INFLIGHT[cache_key] = future
+    try:
+        result = await _cached_groq_call(cache_key, text_description, image_bytes)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # Marcar como consumida si nadie más esperaba
+        raise
+    finally:
+        del _GROQ_INFLIGHT[cache_key]
+
+
+async def _cached_groq_call(cache_key: str, text_description: str, image_bytes: Optional[bytes]) -> Optional[Dict]:
+    """Consulta Redis y, si no está, llama a Groq bajo el cerrojo distribuido."""
+    cached = await cache_get_json(cache_key, ttl=GROQ_CACHE_TTL)
+    if cached:
+        logger.debug("⚡ Respuesta de Groq servida desde caché")
+        _GROQ_L1.set(cache_key, cached)
+        return cached
+    
+    lock_key = f"{cache_key}:lock"
+    locked = await cache_try_lock(lock_key, GROQ_LOCK_TTL)
+    if not locked:
+        # Otro proceso ya está preguntando lo mismo: esperar a su resultado
+        for _ in range(int(GROQ_LOCK_TTL / GROQ_LOCK_POLL_INTERVAL)):
+            await asyncio.sleep(GROQ_LOCK_POLL_INTERVAL)
+            cached = await cache_get_json(cache_key)
+            if cached:
+                _GROQ_L1.set(cache_key, cached)
+                return cached
+        # El otro proceso falló o tardó demasiado: preguntar nosotros
+    
     try:
-        # SYSTEM PROMPT como nutricionista clínico
-        system_prompt = """Eres un nutricionista clínico experto. Tu única base de datos de referencia es el USDA FoodData Central.
+        result = await _call_groq_nutrition(text_description, image_bytes)
+        if result:
+            _GROQ_L1.set(cache_key, result)
+            await cache_set_json(cache_key, result, GROQ_CACHE_TTL)
+        return result
+    finally:
+        if locked:
+            await cache_delete(lock_key)
+
+
+# ==========================================
+# PROMPTS DE GROQ (constantes de módulo)
+# ==========================================
+
+GROQ_NUTRITION_SYSTEM_PROMPT = """Eres un nutricionista clínico experto. Tu única base de datos de referencia es el USDA FoodData Central.
 
 REGLAS INQUEBRANTABLES:
 1. NUNCA calcules calorías ni kcal. Ese campo NO existe en tu respuesta.
@@ -329,37 +386,87 @@ REGLAS INQUEBRANTABLES:
 5. Usa valores realistas del USDA. Ejemplo: 250g pasta cocida = ~8g prot, ~78g carbs, ~3g grasa.
 6. Responde ÚNICAMENTE con JSON válido. Sin explicaciones, sin markdown."""
 
-        # USER PROMPT
-        user_prompt = f"""El usuario ha comido: "{text_description}"
+# El prompt de usuario se arma por concatenación: prefijo + descripción + sufijo
+GROQ_NUTRITION_USER_PREFIX = 'El usuario ha comido: "'
+GROQ_NUTRITION_USER_SUFFIX = '''"
 
 Devuelve un JSON con esta estructura EXACTA (sin campo de calorías):
-{{"foods": [{{{{
+{"foods": [{{
   "alimento": "nombre descriptivo del plato",
   "cantidad_g": 250,
   "proteinas_g": 8.0,
   "carbohidratos_g": 30.0,
   "grasas_g": 6.0
-}}}}]}}
+}}]}
 
 Si hay varios alimentos, pon un objeto por cada uno en el array.
 PROHIBIDO incluir "calorias", "kcal", "energy" o cualquier campo de calorías.
-Responde SOLO con el JSON."""
+Responde SOLO con el JSON.'''
+
+
+def _image_data_url(image_bytes: bytes) -> str:
+    """
+    Data URL JPEG en base64 para los mensajes multimodales de Groq.
+    
+    Se concatena en bytes y se decodifica una sola vez: con f-string habría
+    dos copias del base64 (varios MB) en memoria. El base64 solo contiene
+    ASCII, así que se decodifica como tal (más rápido que UTF-8).
+    """
+    return (b"data:image/jpeg;base64," + base64.b64encode(image_bytes)).decode("ascii")
+
+
+def _prepare_image_data_url(image_bytes: bytes) -> str:
+    """Recompresión (si hace falta) + base64: todo el trabajo de CPU de la imagen."""
+    if image_processing.needs_recompression(image_bytes):
+        image_bytes = image_processing.recompress_jpeg_sync(image_bytes)
+    return _image_data_url(image_bytes)
+
+
+async def _encode_image_for_groq(image_bytes: bytes) -> str:
+    """
+    Data URL de la imagen para Groq.
+    
+    PNG y fotos grandes se reducen a 1024 px y se recomprimen a JPEG antes
+    de codificarlas. Ambos pasos van juntos al pool de visión: el base64 de
+    varios MB también bloquearía el event loop (y las búsquedas OFF/USDA
+    que corren en paralelo).
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        image_processing.CV_EXECUTOR, _prepare_image_data_url, image_bytes
+    )
+
+
+async def _call_groq_nutrition(
+    text_description: str,
+    image_bytes: Optional[bytes] = None
+) -> Optional[Dict]:
+    """
+    Llamada real a Groq (LLaMA) sin caché.
+    
+    ESTRATEGIA ANTI-ALUCINACIÓN:
+    1. Groq SOLO estima macronutrientes (proteínas, carbohidratos, grasas)
+    2. PROHIBIDO que Groq calcule calorías → las calcula Python vía Atwater
+    3. Si no se especifican gramos, estima ración estándar realista
+    4. Temperatura 0.1 para máxima precisión factual
+    """
+    try:
+        user_prompt = GROQ_NUTRITION_USER_PREFIX + text_description + GROQ_NUTRITION_USER_SUFFIX
         
         # Llamar a Groq con imagen (multimodal) o solo texto
         if image_bytes:
-            import base64 as b64
-            image_data = b64.standard_b64encode(image_bytes).decode("utf-8")
-            message = groq_client.chat.completions.create(
+            image_url = await _encode_image_for_groq(image_bytes)
+            message = await _groq_create(
                 model="meta-llama/llama-4-scout-17b-16e-instruct",
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": GROQ_NUTRITION_SYSTEM_PROMPT},
                     {
                         "role": "user",
                         "content": [
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_data}",
+                                    "url": image_url,
                                 },
                             },
                             {
@@ -370,42 +477,33 @@ Responde SOLO con el JSON."""
                     }
                 ],
                 temperature=0.1,
-                max_tokens=512
+                max_tokens=512,
+                response_format={"type": "json_object"}
             )
         else:
-            message = groq_client.chat.completions.create(
+            message = await _groq_create(
                 model=GROQ_MODEL,
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": GROQ_NUTRITION_SYSTEM_PROMPT},
                     {"role": "user", "content": user_prompt}
                 ],
                 temperature=0.1,
-                max_tokens=512
+                max_tokens=512,
+                response_format={"type": "json_object"}
             )
         
         response_text = message.choices[0].message.content.strip()
-        print(f"🤖 Groq raw response: {response_text[:300]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🤖 Groq raw response: %s", response_text[:300])
         
-        # Limpiar markdown si existe
-        for marker in ["```json", "```"]:
-            response_text = response_text.replace(marker, "")
-        response_text = response_text.strip()
-        
-        # Intentar parsear JSON directamente
-        result = None
+        # JSON mode: Groq garantiza un objeto JSON válido, sin markdown que limpiar
         try:
-            result = json.loads(response_text)
-        except json.JSONDecodeError:
-            # Si falla, buscar JSON en la respuesta con regex
-            json_match = re.search(r'\{[\s\S]*\}', response_text)
-            if json_match:
-                try:
-                    result = json.loads(json_match.group())
-                except json.JSONDecodeError:
-                    pass
+            result = orjson.loads(response_text)
+        except orjson.JSONDecodeError:
+            result = None
         
         if not result or "foods" not in result or not result["foods"]:
-            print(f"⚠️ Groq no retornó JSON válido: {response_text[:150]}")
+            logger.warning("⚠️ Groq no retornó JSON válido: %s", response_text[:150])
             return None
         
         # POST-PROCESO: Calcular calorías vía Atwater y normalizar formato
@@ -428,8 +526,14 @@ Responde SOLO con el JSON."""
             carbs_100 = round(carbs_total * factor, 1)
             fat_100 = round(fat_total * factor, 1)
             
-            print(f"  ✅ {name}: {cantidad_g}g → {kcal_total} kcal (Atwater: P{prot_total}×4 + C{carbs_total}×4 + G{fat_total}×9)")
-            print(f"     Per 100g: {kcal_100} kcal | {prot_100}g prot | {carbs_100}g carbs | {fat_100}g fat")
+            logger.debug(
+                "✅ %s: %sg → %s kcal (Atwater: P%s×4 + C%s×4 + G%s×9)",
+                name, cantidad_g, kcal_total, prot_total, carbs_total, fat_total
+            )
+            logger.debug(
+                "   Per 100g: %s kcal | %sg prot | %sg carbs | %sg fat",
+                kcal_100, prot_100, carbs_100, fat_100
+            )
             
             normalized_foods.append({
                 "name": name,
@@ -443,92 +547,275 @@ Responde SOLO con el JSON."""
         return {"foods": normalized_foods}
         
     except Exception as e:
-        print(f"❌ Error Groq: {e}")
+        logger.error("❌ Error Groq: %s", e)
+        return None
+
+
+# ==========================================
+# CACHÉ PERSISTENTE (PostgreSQL)
+# ==========================================
+
+# Último nivel de caché, detrás de L1 y Redis: sobrevive a reinicios y despliegues.
+# Solo guarda aciertos; los "no encontrado" se quedan en las cachés volátiles
+PERSISTENT_CACHE_MAX_AGE = 30 * 24 * 3600
+
+
+async def _persistent_cache_get(cache_key: str) -> Optional["NutritionalData"]:
+    """Lee de la tabla nutrition_cache. Cualquier fallo cuenta como fallo de caché."""
+    if db.pool is None:
+        return None
+    try:
+        row = await db.get_cached_nutrition(cache_key, PERSISTENT_CACHE_MAX_AGE)
+    except Exception as e:
+        logger.warning("⚠️ Caché persistente GET %s falló: %s", cache_key, e)
         return None
+    return NutritionalData(**row) if row else None
+
+
+# Las escrituras van a una cola que un task de fondo vacía por lotes: la
+# respuesta al usuario no espera al INSERT
+PERSISTENT_WRITE_BATCH = 50
+PERSISTENT_WRITE_WAIT = 0.2
+_WRITE_QUEUE: Optional[asyncio.Queue] = None
+_WRITER_TASK: Optional[asyncio.Task] = None
+
+
+def _persistent_cache_put(cache_key: str, result: "NutritionalData") -> None:
+    """Encola un resultado para guardarlo en nutrition_cache (no bloquea)."""
+    global _WRITE_QUEUE, _WRITER_TASK
+    if db.pool is None:
+        return
+    if _WRITE_QUEUE is None:
+        _WRITE_QUEUE = asyncio.Queue()
+    if _WRITER_TASK is None or _WRITER_TASK.done():
+        _WRITER_TASK = asyncio.create_task(_persistent_cache_writer())
+    _WRITE_QUEUE.put_nowait((cache_key, result.to_dict()))
+
+
+async def _persistent_cache_writer() -> None:
+    """
+    Consumidor de la cola: junta hasta PERSISTENT_WRITE_BATCH entradas o
+    PERSISTENT_WRITE_WAIT segundos desde la primera y las guarda de una vez.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _WRITE_QUEUE.get()]
+        deadline = loop.time() + PERSISTENT_WRITE_WAIT
+        while len(batch) < PERSISTENT_WRITE_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_WRITE_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            await db.set_cached_nutrition_many(batch)
+        except Exception as e:
+            logger.warning("⚠️ Caché persistente: no se guardaron %s entradas: %s", len(batch), e)
+        finally:
+            for _ in batch:
+                _WRITE_QUEUE.task_done()
+
+
+async def flush_persistent_cache(timeout: float = 5.0) -> None:
+    """
+    Espera a que se guarde lo pendiente y detiene el escritor.
+    Llamar en el apagado, ANTES de cerrar la base de datos.
+    """
+    global _WRITER_TASK
+    if _WRITER_TASK is None:
+        return
+    if not _WRITER_TASK.done():
+        try:
+            await asyncio.wait_for(_WRITE_QUEUE.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ Caché persistente: %s entradas sin guardar", _WRITE_QUEUE.qsize())
+        _WRITER_TASK.cancel()
+        try:
+            await _WRITER_TASK
+        except asyncio.CancelledError:
+            pass
+    _WRITER_TASK = None
 
 
 # ==========================================
 # OPEN FOOD FACTS - BÚSQUEDA POR CÓDIGO DE BARRAS
 # ==========================================
 
-async def search_open_food_facts_by_barcode(barcode: str, image_bytes: Optional[bytes] = None) -> Optional[NutritionalData]:
+# Los datos nutricionales de un producto cambian muy poco: 7 días en Redis
+BARCODE_CACHE_TTL = 7 * 24 * 3600
+# Códigos desconocidos: se recuerdan 1h para no repetir 6 APIs en bucle
+BARCODE_NEGATIVE_TTL = 3600
+
+# L1 en memoria delante de Redis. TTL corto (< TTL de Redis) para que una
+# corrección hecha en Redis se propague pronto a todos los procesos
+_BARCODE_L1 = TTLCache(maxsize=5000, ttl=60)
+
+# Centinela de L1: distingue "no está en caché" de "se sabe que no existe" (None)
+_MISSING = object()
+
+
+def _barcode_cache_key(barcode: str) -> str:
+    return f"nutri:off:{barcode}:v1"
+
+
+def _barcode_miss_key(barcode: str) -> str:
+    # Clave aparte para los "no encontrado": se lee sin refresco anticipado
+    # (su TTL de 1h siempre estaría por debajo del umbral calculado con 7 días)
+    return f"nutri:off:{barcode}:miss:v1"
+
+
+async def get_nutrition_for_barcode(barcode: str) -> Optional[NutritionalData]:
     """
-    Busca un alimento por código de barras en MÚLTIPLES APIs (fallback strategy).
+    Datos nutricionales de un código de barras con caché en varios niveles.
     
-    INTENTA (en orden de confiabilidad):
-    1. Open Food Facts (gratuito, muchos datos nutricionales)
-    2. EAN Search (gratuito, base de datos EAN europea)
-    3. Barcode Lookup (gratuito, 500 req/día)
-    4. UPC Database (gratuito, trial mode, cobertura USA)
-    5. Código Base Online (alternativa)
+    ORDEN:
+    1. L1 en memoria (~60s): aciertos y "no encontrado"
+    2. Redis, clave de datos (7 días, con refresco anticipado)
+    3. Redis, clave de fallos (1h): código que ninguna API conoce
+    4. Tabla nutrition_cache de PostgreSQL (30 días, solo aciertos)
+    5. APIs externas
     
-    Returns:
-        NutritionalData si se encuentra, None si no
+    Un acierto en un nivel rellena los anteriores; un acierto en las APIs
+    rellena todos y un fallo se guarda en L1 y en la clave de fallos.
     """
-    from src.config import BARCODE_LOOKUP_API, UPC_DATABASE_API
-    
-    # INTENTO 1: Open Food Facts
-    print(f"🔍 Intento 1: Buscando {barcode} en Open Food Facts...")
-    result = await _search_off_barcode(barcode)
-    if result:
-        print(f"✅ Encontrado en Open Food Facts: {result.food_name}")
+    result = _BARCODE_L1.get(barcode, _MISSING)
+    if result is not _MISSING:
         return result
     
-    # INTENTO 2: EAN Search (base de datos europea de EAN)
-    print(f"🔍 Intento 2: Buscando en EAN Search...")
-    result = await _search_ean_search(barcode)
-    if result:
-        print(f"✅ Encontrado en EAN Search: {result.food_name}")
+    cache_key = _barcode_cache_key(barcode)
+    cached = await cache_get_json(cache_key, ttl=BARCODE_CACHE_TTL)
+    if cached is not None:
+        logger.debug("⚡ Código %s servido desde caché", barcode)
+        result = NutritionalData(**cached) if cached else None
+        _BARCODE_L1.set(barcode, result)
         return result
     
-    # INTENTO 3: Barcode Lookup
-    print(f"🔍 Intento 3: Buscando en Barcode Lookup...")
-    result = await _search_barcode_lookup(barcode)
+    if await cache_get_json(_barcode_miss_key(barcode)) is not None:
+        logger.debug("⚡ Código %s sin datos (caché negativa)", barcode)
+        _BARCODE_L1.set(barcode, None)
+        return None
+    
+    result = await _persistent_cache_get(cache_key)
     if result:
-        print(f"✅ Encontrado en Barcode Lookup: {result.food_name}")
+        _BARCODE_L1.set(barcode, result)
+        await cache_set_json(cache_key, result.to_dict(), BARCODE_CACHE_TTL)
         return result
     
-    # INTENTO 4: UPC Database
-    print(f"🔍 Intento 4: Buscando en UPC Database...")
-    result = await _search_upc_database(barcode)
+    result = await _search_barcode_apis(barcode)
+    _BARCODE_L1.set(barcode, result)
     if result:
-        print(f"✅ Encontrado en UPC Database: {result.food_name}")
-        return result
+        await cache_set_json(cache_key, result.to_dict(), BARCODE_CACHE_TTL)
+        _persistent_cache_put(cache_key, result)
+    else:
+        await cache_set_json(_barcode_miss_key(barcode), {}, BARCODE_NEGATIVE_TTL)
+    return result
+
+
+async def invalidate_barcode_cache(barcode: str) -> None:
+    """Invalida ambos niveles de caché de un código (ej: tras corregir sus datos)."""
+    _BARCODE_L1.pop(barcode)
+    await cache_delete(_barcode_cache_key(barcode))
+    await cache_delete(_barcode_miss_key(barcode))
+
+
+async def search_open_food_facts_by_barcode(barcode: str, image_bytes: Optional[bytes] = None) -> Optional[NutritionalData]:
+    """
+    Busca un alimento por código de barras en MÚLTIPLES APIs (fallback strategy).
+    
+    CONSULTA (todas en paralelo, prioridad por confiabilidad):
+    0. Caché L1 (memoria) + L2 (Redis) - evita repetir las APIs en productos populares
+    1. Open Food Facts (gratuito, muchos datos nutricionales)
+    2. EAN Search (gratuito, base de datos EAN europea)
+    3. Barcode Lookup (gratuito, 500 req/día)
+    4. UPC Database (gratuito, trial mode, cobertura USA)
+    5. Código Base Online (alternativa)
+    6. Barcode Monster (última alternativa)
     
-    # INTENTO 5: Barcode Database (alternativa)
-    print(f"🔍 Intento 5: Buscando en Barcode Database...")
-    result = await _search_barcode_database(barcode)
+    El fallback de Groq sobre la imagen NO se cachea: depende de la foto, no del código.
+    
+    Returns:
+        NutritionalData si se encuentra, None si no
+    """
+    result = await get_nutrition_for_barcode(barcode)
     if result:
-        print(f"✅ Encontrado en Barcode Database: {result.food_name}")
         return result
     
-    print(f"⚠️ Código NO encontrado en BDs externas")
-    print(f"❌ Código {barcode} no encontrado en ninguna base de datos")
+    logger.info("❌ Código %s no encontrado en ninguna base de datos", barcode)
     
     # FALLBACK: Si tenemos imagen, intentar extraer datos directo con Groq
     if image_bytes:
-        print(f"🔍 FALLBACK: Analizando etiqueta nutricional con Groq...")
+        logger.info("🔍 FALLBACK: Analizando etiqueta nutricional con Groq...")
         result = await _analyze_nutrition_label_with_groq(image_bytes)
         if result:
-            print(f"✅ Groq logró extraer datos de la etiqueta")
+            logger.info("✅ Groq logró extraer datos de la etiqueta")
             return result
     
     return None
 
 
+async def _search_barcode_apis(barcode: str) -> Optional[NutritionalData]:
+    """
+    Consulta TODAS las APIs de códigos de barras a la vez y elige por confiabilidad.
+    
+    Las peticiones son independientes y limitadas por red: lanzadas en paralelo,
+    la latencia pasa de la suma de RTTs a (como mucho) el más lento.
+    Los resultados se recogen en orden de prioridad, así que gana la primera
+    fuente fiable que responda algo, igual que con el recorrido secuencial.
+    """
+    logger.debug("🔍 Buscando %s en %d APIs en paralelo...", barcode, len(_BARCODE_SOURCES))
+    tasks = [
+        (label, asyncio.create_task(search(barcode)))
+        for label, search in _BARCODE_SOURCES
+    ]
+    
+    try:
+        for label, task in tasks:
+            result = await task
+            if result:
+                logger.info("✅ Encontrado en %s: %s", label, result.food_name)
+                return result
+        return None
+    finally:
+        # Las fuentes de menor prioridad que sigan en vuelo ya no hacen falta
+        for _, task in tasks:
+            task.cancel()
+
+
+# OFF devuelve la ficha completa (50-200 KB) salvo que se pidan campos concretos.
+# Se usa también en la búsqueda por nombre
+OFF_BARCODE_PARAMS = {"fields": "product_name,nutriments"}
+
+# Nombres alternativos de cada nutriente en OFF (gana el primero con valor).
+# El orden importa: se desempaqueta como calories, protein, carbs, fat
+OFF_NUTRIENT_KEYS = {
+    "calories": ("energy-kcal_100g", "energy_kcal_100g", "energy-kcal", "energy_100g"),
+    "protein": ("proteins_100g", "protein_100g", "proteins"),
+    "carbs": ("carbohydrates_100g", "carbs_100g", "carbohydrates"),
+    "fat": ("fat_100g", "fats_100g", "fat"),
+}
+
+
+def _first_present(data: Dict, keys: Tuple[str, ...]):
+    """Primer valor no vacío entre varias claves alternativas (0 si ninguna)."""
+    return next((data[k] for k in keys if data.get(k)), 0)
+
+
 async def _search_off_barcode(barcode: str) -> Optional[NutritionalData]:
     """Open Food Facts - API principal."""
     try:
         url = f"{OFF_API_ENDPOINT}/{barcode}.json"
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                if resp.status == 404:
-                    return None
-                if resp.status != 200:
-                    return None
+        session = await get_http_session()
+        async with session.get(url, params=OFF_BARCODE_PARAMS) as resp:
+            if resp.status == 404:
+                return None
+            if resp.status != 200:
+                return None
                 
-                data = await resp.json()
+            data = orjson.loads(await resp.read())
         
         product = data.get("product", {})
         if not product:
@@ -538,29 +825,8 @@ async def _search_off_barcode(barcode: str) -> Optional[NutritionalData]:
         nutrients = product.get("nutriments", {}) or product.get("nutrients", {})
         
         # Intentar múltiples keys para cada nutriente
-        calories = (
-            nutrients.get("energy-kcal_100g") or
-            nutrients.get("energy_kcal_100g") or
-            nutrients.get("energy-kcal") or
-            nutrients.get("energy_100g", 0)
-        )
-        
-        protein = (
-            nutrients.get("proteins_100g") or
-            nutrients.get("protein_100g") or
-            nutrients.get("proteins") or 0
-        )
-        
-        carbs = (
-            nutrients.get("carbohydrates_100g") or
-            nutrients.get("carbs_100g") or
-            nutrients.get("carbohydrates") or 0
-        )
-        
-        fat = (
-            nutrients.get("fat_100g") or
-            nutrients.get("fats_100g") or
-            nutrients.get("fat") or 0
+        calories, protein, carbs, fat = (
+            _first_present(nutrients, keys) for keys in OFF_NUTRIENT_KEYS.values()
         )
         
         food_name = product.get("product_name", "Unknown (OFF)")
@@ -579,24 +845,22 @@ async def _search_off_barcode(barcode: str) -> Optional[NutritionalData]:
         )
         
     except Exception as e:
-        print(f"  ⚠️ OFF Error: {str(e)}")
+        logger.warning("⚠️ OFF Error: %s", e)
         return None
 
 
 async def _search_barcode_lookup(barcode: str) -> Optional[NutritionalData]:
     """Barcode Lookup - Alternativa con buena cobertura."""
     try:
-        from src.config import BARCODE_LOOKUP_API
-        
         url = BARCODE_LOOKUP_API
         params = {"barcode": barcode, "formatted": "json"}
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                if resp.status != 200:
-                    return None
+        session = await get_http_session()
+        async with session.get(url, params=params) as resp:
+            if resp.status != 200:
+                return None
                 
-                data = await resp.json()
+            data = orjson.loads(await resp.read())
         
         # Barcode Lookup devuelve estructura diferente
         if not data.get("success"):
@@ -623,24 +887,22 @@ async def _search_barcode_lookup(barcode: str) -> Optional[NutritionalData]:
         )
         
     except Exception as e:
-        print(f"  ⚠️ Barcode Lookup Error: {str(e)}")
+        logger.warning("⚠️ Barcode Lookup Error: %s", e)
         return None
 
 
 async def _search_upc_database(barcode: str) -> Optional[NutritionalData]:
     """UPC Database - Trial API con buena cobertura USA."""
     try:
-        from src.config import UPC_DATABASE_API
-        
         url = UPC_DATABASE_API
         params = {"upc": barcode}
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                if resp.status != 200:
-                    return None
+        session = await get_http_session()
+        async with session.get(url, params=params) as resp:
+            if resp.status != 200:
+                return None
                 
-                data = await resp.json()
+            data = orjson.loads(await resp.read())
         
         if data.get("code") != "OK":
             return None
@@ -662,7 +924,7 @@ async def _search_upc_database(barcode: str) -> Optional[NutritionalData]:
         )
         
     except Exception as e:
-        print(f"  ⚠️ UPC Database Error: {str(e)}")
+        logger.warning("⚠️ UPC Database Error: %s", e)
         return None
 
 
@@ -672,12 +934,12 @@ async def _search_ean_search(barcode: str) -> Optional[NutritionalData]:
         # EAN Search API: https://www.ean-search.org/
         url = f"https://api.ean-search.org/api?format=json&barcode={barcode}"
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                if resp.status != 200:
-                    return None
+        session = await get_http_session()
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                return None
                 
-                data = await resp.json()
+            data = orjson.loads(await resp.read())
         
         if not data.get("barcode"):
             return None
@@ -697,7 +959,7 @@ async def _search_ean_search(barcode: str) -> Optional[NutritionalData]:
         )
         
     except Exception as e:
-        print(f"  ⚠️ EAN Search Error: {str(e)}")
+        logger.warning("⚠️ EAN Search Error: %s", e)
         return None
 
 
@@ -707,20 +969,19 @@ async def _search_barcode_database(barcode: str) -> Optional[NutritionalData]:
         # Barcodes.online API: https://barcodes.online/
         url = f"https://api.barcodes.online/api/barcodes/{barcode}"
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                if resp.status not in [200, 201]:
-                    # Intentar alternativa
-                    return await _search_barcode_monster(barcode)
+        session = await get_http_session()
+        async with session.get(url) as resp:
+            if resp.status not in [200, 201]:
+                return None
                 
-                data = await resp.json()
+            data = orjson.loads(await resp.read())
         
         if not data:
-            return await _search_barcode_monster(barcode)
+            return None
         
         product_name = data.get("name", data.get("title", "Unknown (Barcode DB)"))
         if not product_name:
-            return await _search_barcode_monster(barcode)
+            return None
         
         return NutritionalData(
             food_name=product_name,
@@ -732,8 +993,8 @@ async def _search_barcode_database(barcode: str) -> Optional[NutritionalData]:
         )
         
     except Exception as e:
-        print(f"  ⚠️ Barcode Database Error: {str(e)}")
-        return await _search_barcode_monster(barcode)
+        logger.warning("⚠️ Barcode Database Error: %s", e)
+        return None
 
 
 async def _search_barcode_monster(barcode: str) -> Optional[NutritionalData]:
@@ -743,12 +1004,12 @@ async def _search_barcode_monster(barcode: str) -> Optional[NutritionalData]:
         url = f"https://api.barcode.monster/search"
         params = {"q": barcode}
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                if resp.status != 200:
-                    return None
+        session = await get_http_session()
+        async with session.get(url, params=params) as resp:
+            if resp.status != 200:
+                return None
                 
-                data = await resp.json()
+            data = orjson.loads(await resp.read())
         
         if not data or not isinstance(data, list) or len(data) == 0:
             return None
@@ -769,31 +1030,202 @@ async def _search_barcode_monster(barcode: str) -> Optional[NutritionalData]:
         )
         
     except Exception as e:
-        print(f"  ⚠️ Barcode Monster Error: {str(e)}")
+        logger.warning("⚠️ Barcode Monster Error: %s", e)
         return None
 
 
+# Fuentes de códigos de barras en orden de confiabilidad (la primera que responde gana)
+_BARCODE_SOURCES = (
+    ("Open Food Facts", _search_off_barcode),
+    ("EAN Search", _search_ean_search),
+    ("Barcode Lookup", _search_barcode_lookup),
+    ("UPC Database", _search_upc_database),
+    ("Barcode Database", _search_barcode_database),
+    ("Barcode Monster", _search_barcode_monster),
+)
+
+
 # ==========================================
-# GROQ IMAGE ANALYSIS - FALLBACK FOR UNKNOWN BARCODES
+# GROQ VISIÓN EN STREAMING (etiquetas y platos)
 # ==========================================
 
-async def _analyze_nutrition_label_with_groq(image_bytes: bytes) -> Optional[NutritionalData]:
+# Con estos campos leídos la respuesta ya está completa: el resto de tokens
+# (explicaciones, notas) se cancela en lugar de esperar a max_tokens
+_VISION_REQUIRED_FIELDS = frozenset({"name", "protein", "carbs", "fat"})
+
+
+async def _stream_groq_vision_fields(
+    prompt: str,
+    image_url: str,
+    temperature: float,
+    parse_line: Callable[[str, Dict], Optional[str]],
+    fields: Dict,
+) -> str:
     """
-    Lee la etiqueta nutricional directamente de la imagen usando Groq con Llama 4 Scout.
-    Usado cuando el código de barras no se encuentra en ninguna BD.
+    Pide a Groq (visión) la respuesta en streaming y la parsea línea a línea.
     
-    ANTI-ALUCINACIÓN: Aunque leemos calorías de la etiqueta, VALIDAMOS
-    contra Atwater. Si hay desviación >20%, usamos el cálculo de Python.
+    parse_line(línea, fields) rellena `fields` y devuelve la clave que leyó.
+    En cuanto están nombre, proteínas, carbohidratos y grasas se corta el
+    stream: el usuario no espera a que el modelo termine de escribir.
+    
+    Returns:
+        El texto recibido (para logging)
     """
+    # El hueco del semáforo se mantiene mientras dura el stream: la generación
+    # ocupa a Groq hasta que se cierra, no solo hasta que se abre
+    stream = await _groq_open_stream(
+        model="meta-llama/llama-4-scout-17b-16e-instruct",
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url,
+                        },
+                    },
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ],
+            }
+        ],
+        temperature=temperature,
+        max_tokens=500,
+        top_p=1,
+    )
+    
+    received = []
+    pending = ""
+    seen = set()
     try:
-        import base64
-        from groq import AsyncGroq
-        from src.config import GROQ_API_KEY
-        
-        groq_client = AsyncGroq(api_key=GROQ_API_KEY)
-        image_data = base64.standard_b64encode(image_bytes).decode("utf-8")
-        
-        prompt = """Eres un nutricionista clínico. Analiza la etiqueta nutricional visible en esta imagen.
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            received.append(delta)
+            
+            # Solo se parsean líneas completas; el trozo final espera al siguiente chunk.
+            # splitlines reconoce también \r\n, y keepends dice si la última está completa
+            lines = (pending + delta).splitlines(keepends=True)
+            pending = "" if lines[-1].endswith(("\n", "\r")) else lines.pop()
+            for line in lines:
+                key = parse_line(line, fields)
+                if key:
+                    seen.add(key)
+            
+            if _VISION_REQUIRED_FIELDS <= seen:
+                pending = ""
+                break
+    finally:
+        try:
+            await stream.close()
+        finally:
+            _get_groq_semaphore().release()
+    
+    # Última línea sin salto de línea final
+    if pending:
+        parse_line(pending, fields)
+    
+    return "".join(received)
+
+
+# Patrón y palabras clave del parser de líneas (compilados una vez, no por línea)
+_NUMBER_RE = re.compile(r'\d+[.,]?\d*')
+_KCAL_KWS = ('caloria', 'caloría', 'energia', 'energía', 'energy', 'kcal')
+_PROT_KWS = ('proteina', 'proteína', 'protein')
+_CARB_KWS = ('carbohidrato', 'hidrato', 'carbohydrate', 'carbs')
+_FAT_KWS = ('grasa', 'lipido', 'lípido', 'fat')
+
+# Tabla de despacho palabra clave → campo. El orden importa: gana la primera
+# palabra que aparezca en la cabecera (lo que va antes de ':')
+_LABEL_FIELDS = {
+    "nombre": "name",
+    **dict.fromkeys(_KCAL_KWS, "calories"),
+    **dict.fromkeys(_PROT_KWS, "protein"),
+    **dict.fromkeys(_CARB_KWS, "carbs"),
+    **dict.fromkeys(_FAT_KWS, "fat"),
+}
+_PLATE_FIELDS = {
+    "nombre": "name",
+    "ingrediente": "ingredients",
+    **dict.fromkeys(_PROT_KWS, "protein"),
+    **dict.fromkeys(_CARB_KWS, "carbs"),
+    **dict.fromkeys(_FAT_KWS, "fat"),
+}
+# Campos de texto (el resto son números)
+_TEXT_FIELDS = frozenset({"name", "ingredients"})
+
+
+def _extract_number(text: str) -> float:
+    """Primer número de un texto ("12,5 g" → 12.5); 0 si no hay."""
+    match = _NUMBER_RE.search(text)
+    if match:
+        return float(match.group().replace(',', '.'))
+    return 0
+
+
+def _parse_field_line(
+    line: str,
+    fields: Dict,
+    dispatch: Dict[str, str],
+    skip: Tuple[str, ...] = (),
+) -> Optional[str]:
+    """
+    Parsea una línea "Campo: valor" en una sola pasada.
+    
+    Se parte por el primer ':' una vez, se pasa la cabecera a minúsculas una
+    vez, se busca la palabra clave y se lee el valor. Las cabeceras que
+    contengan algo de `skip` se ignoran. Devuelve el campo leído (o None).
+    """
+    head, sep, tail = line.partition(':')
+    head_lc = head.lower()
+    if skip and any(k in head_lc for k in skip):
+        return None
+    key = next((field for keyword, field in dispatch.items() if keyword in head_lc), None)
+    if key is None:
+        return None
+    
+    if key in _TEXT_FIELDS:
+        if not sep:
+            return None
+        fields[key] = tail.strip().strip('*').strip()
+        return key
+    
+    val = _extract_number(tail if sep else line)
+    if val > 0:
+        fields[key] = val
+    return key
+
+
+def _parse_label_line(line: str, fields: Dict) -> Optional[str]:
+    """Parsea una línea de la respuesta de etiqueta. Devuelve la clave leída."""
+    stripped = line.strip()
+    if not stripped or stripped.startswith('**') or stripped.startswith('#'):
+        return None
+    return _parse_field_line(stripped, fields, _LABEL_FIELDS)
+
+
+def _parse_plate_line(line: str, fields: Dict) -> Optional[str]:
+    """Parsea una línea de la respuesta de plato. Devuelve la clave leída."""
+    stripped = line.strip()
+    if not stripped or (stripped.startswith('**') and stripped.endswith('**')):
+        return None
+    # "Grasas saturadas" no debe pisar las grasas totales
+    return _parse_field_line(stripped, fields, _PLATE_FIELDS, skip=("saturad",))
+
+
+# ==========================================
+# GROQ IMAGE ANALYSIS - FALLBACK FOR UNKNOWN BARCODES
+# ==========================================
+
+# Pre-filtro OCR: una etiqueta legible tiene varios números y alguna palabra clave
+LABEL_MIN_NUMBERS = 3
+_LABEL_KWS = _KCAL_KWS + _PROT_KWS + _CARB_KWS + _FAT_KWS
+
+GROQ_LABEL_PROMPT = """Eres un nutricionista clínico. Analiza la etiqueta nutricional visible en esta imagen.
 
 EXTRAE SOLO lo que puedas LEER en la etiqueta. Valores POR 100g:
 - Nombre del producto
@@ -812,80 +1244,69 @@ Calorias: [valor o NO ENCONTRADO]
 Proteinas: [valor]
 Carbohidratos: [valor]
 Grasas: [valor]"""
+
+
+async def _may_contain_label(image_bytes: bytes) -> bool:
+    """
+    Comprobación local y barata antes de pagar la llamada de visión a Groq.
+    
+    Si el OCR no está disponible o falla, no se descarta nada (True).
+    """
+    loop = asyncio.get_running_loop()
+    text = await loop.run_in_executor(
+        image_processing.CV_EXECUTOR, image_processing.ocr_text_sync, image_bytes
+    )
+    if text is None:
+        return True
+    
+    text = text.lower()
+    return (
+        len(_NUMBER_RE.findall(text)) >= LABEL_MIN_NUMBERS
+        and any(k in text for k in _LABEL_KWS)
+    )
+
+
+async def _analyze_nutrition_label_with_groq(image_bytes: bytes) -> Optional[NutritionalData]:
+    """
+    Lee la etiqueta nutricional directamente de la imagen usando Groq con Llama 4 Scout.
+    Usado cuando el código de barras no se encuentra en ninguna BD.
+    
+    ANTI-ALUCINACIÓN: Aunque leemos calorías de la etiqueta, VALIDAMOS
+    contra Atwater. Si hay desviación >20%, usamos el cálculo de Python.
+    
+    PRE-FILTRO: si el OCR local no ve números ni palabras de etiqueta
+    (foto borrosa, no es una etiqueta) no se llama a Groq.
+    """
+    try:
+        if not await _may_contain_label(image_bytes):
+            logger.info("📸 El OCR no ve una etiqueta nutricional: se omite Groq")
+            return None
         
-        print(f"📸 Analizando etiqueta con Groq Llama 4 Scout...")
-        
-        message = await groq_client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_data}",
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ],
-                }
-            ],
-            temperature=0.1,
-            max_tokens=500,
-            top_p=1,
+        image_url = await _encode_image_for_groq(image_bytes)
+        
+        logger.debug("📸 Analizando etiqueta con Groq Llama 4 Scout...")
+        
+        fields = {
+            "name": "Unknown (Groq Analysis)",
+            "calories": 0,
+            "protein": 0,
+            "carbs": 0,
+            "fat": 0,
+        }
+        response_text = await _stream_groq_vision_fields(
+            GROQ_LABEL_PROMPT, image_url, 0.1, _parse_label_line, fields
         )
+        logger.debug("📸 Groq Label Response:\n%s", response_text)
         
-        response_text = message.choices[0].message.content
-        print(f"📸 Groq Label Response:\n{response_text}")
-        
-        # Parsear respuesta
-        product_name = "Unknown (Groq Analysis)"
-        calories_reported = 0
-        protein = 0
-        carbs = 0
-        fat = 0
-        
-        def _extract_number(text: str) -> float:
-            import re as _re
-            match = _re.search(r'[\d]+[.,]?[\d]*', text)
-            if match:
-                return float(match.group().replace(',', '.'))
-            return 0
-        
-        for line in response_text.split('\n'):
-            line_lower = line.lower().strip()
-            if not line_lower or line_lower.startswith('**') or line_lower.startswith('#'):
-                continue
-            
-            if 'nombre:' in line_lower or 'nombre ' in line_lower:
-                for separator in ['Nombre:', 'nombre:', 'NOMBRE:']:
-                    if separator in line:
-                        product_name = line.split(separator)[-1].strip().strip('*').strip()
-                        break
-            elif any(k in line_lower for k in ['caloria', 'caloría', 'energia', 'energía', 'energy', 'kcal']):
-                val = _extract_number(line.split(':')[-1] if ':' in line else line)
-                if val > 0:
-                    calories_reported = val
-            elif any(k in line_lower for k in ['proteina', 'proteína', 'protein']):
-                val = _extract_number(line.split(':')[-1] if ':' in line else line)
-                if val > 0:
-                    protein = val
-            elif any(k in line_lower for k in ['carbohidrato', 'hidrato', 'carbohydrate', 'carbs']):
-                val = _extract_number(line.split(':')[-1] if ':' in line else line)
-                if val > 0:
-                    carbs = val
-            elif any(k in line_lower for k in ['grasa', 'lipido', 'lípido', 'fat', 'grasas']):
-                val = _extract_number(line.split(':')[-1] if ':' in line else line)
-                if val > 0:
-                    fat = val
+        product_name = fields["name"]
+        calories_reported = fields["calories"]
+        protein = fields["protein"]
+        carbs = fields["carbs"]
+        fat = fields["fat"]
         
         # Validar que al menos tengamos el nombre
         if product_name == "Unknown (Groq Analysis)":
-            print(f"⚠️ No se pudo extraer nombre del producto")
+            logger.warning("⚠️ No se pudo extraer nombre del producto")
             return None
         
         # ANTI-ALUCINACIÓN: Validar calorías contra Atwater
@@ -895,11 +1316,14 @@ Grasas: [valor]"""
         elif protein > 0 or carbs > 0 or fat > 0:
             # No reportó calorías → calcular con Atwater
             calories_final = _atwater_kcal(protein, carbs, fat)
-            print(f"  📐 Calorías calculadas por Atwater: {calories_final} kcal/100g")
+            logger.debug("📐 Calorías calculadas por Atwater: %s kcal/100g", calories_final)
         else:
             calories_final = calories_reported
         
-        print(f"✅ Etiqueta: {product_name} | {calories_final}kcal | {protein}g prot | {carbs}g carbs | {fat}g grasas")
+        logger.info(
+            "✅ Etiqueta: %s | %skcal | %sg prot | %sg carbs | %sg grasas",
+            product_name, calories_final, protein, carbs, fat
+        )
         
         return NutritionalData(
             food_name=product_name,
@@ -911,7 +1335,7 @@ Grasas: [valor]"""
         )
         
     except Exception as e:
-        print(f"  ⚠️ Groq Image Analysis Error: {str(e)}")
+        logger.warning("⚠️ Groq Image Analysis Error: %s", e)
         return None
 
 
@@ -919,23 +1343,7 @@ Grasas: [valor]"""
 # GROQ FOOD PLATE ANALYSIS - IDENTIFICAR PLATOS DE COMIDA
 # ==========================================
 
-async def analyze_food_plate_with_groq(image_bytes: bytes) -> Optional[NutritionalData]:
-    """
-    Analiza una foto de un plato de comida usando Groq con visión.
-    Identifica ingredientes, estima tipo de comida. Calorías se calculan vía Atwater.
-    
-    ANTI-ALUCINACIÓN: Groq NO calcula calorías. Solo reporta macros por 100g.
-    Python calcula kcal = (P×4) + (C×4) + (G×9).
-    """
-    try:
-        import base64
-        from groq import AsyncGroq
-        from src.config import GROQ_API_KEY
-        
-        groq_client = AsyncGroq(api_key=GROQ_API_KEY)
-        image_data = base64.standard_b64encode(image_bytes).decode("utf-8")
-        
-        prompt = """Eres un nutricionista clínico experto usando la base de datos USDA FoodData Central.
+GROQ_PLATE_PROMPT = """Eres un nutricionista clínico experto usando la base de datos USDA FoodData Central.
 
 Analiza esta foto de comida. Identifica el plato y sus ingredientes principales.
 
@@ -963,112 +1371,89 @@ Ingredientes: [lista separada por coma]
 Proteinas: [valor numerico por 100g]
 Carbohidratos: [valor numerico por 100g]
 Grasas: [valor numerico por 100g]"""
+
+
+async def analyze_food_plate_with_groq(image_bytes: bytes) -> Optional[NutritionalData]:
+    """
+    Analiza una foto de un plato de comida usando Groq con visión.
+    Identifica ingredientes, estima tipo de comida. Calorías se calculan vía Atwater.
+    
+    ANTI-ALUCINACIÓN: Groq NO calcula calorías. Solo reporta macros por 100g.
+    Python calcula kcal = (P×4) + (C×4) + (G×9).
+    """
+    try:
+        image_url = await _encode_image_for_groq(image_bytes)
         
-        print(f"📸 Analizando plato de comida con Groq Llama 4 Scout...")
-        
-        message = await groq_client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_data}",
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ],
-                }
-            ],
-            temperature=0.2,
-            max_tokens=500,
-            top_p=1,
-        )
-        
-        response_text = message.choices[0].message.content
-        print(f"📸 Groq Plate Analysis Response:\n{response_text}")
-        
-        # Parsear respuesta
-        import re as _re
-        
-        product_name = "Plato no identificado"
-        ingredients = ""
-        protein = 0
-        carbs = 0
-        fat = 0
-        
-        def _extract_num(text: str) -> float:
-            match = _re.search(r'[\d]+[.,]?[\d]*', text)
-            if match:
-                return float(match.group().replace(',', '.'))
-            return 0
-        
-        for line in response_text.split('\n'):
-            line_lower = line.lower().strip()
-            if not line_lower or (line_lower.startswith('**') and line_lower.endswith('**')):
-                continue
-            
-            if 'nombre:' in line_lower:
-                for sep in ['Nombre:', 'nombre:', 'NOMBRE:']:
-                    if sep in line:
-                        product_name = line.split(sep)[-1].strip().strip('*').strip()
-                        break
-            elif 'ingrediente' in line_lower:
-                for sep in ['Ingredientes:', 'ingredientes:', 'INGREDIENTES:']:
-                    if sep in line:
-                        ingredients = line.split(sep)[-1].strip().strip('*').strip()
-                        break
-            elif any(k in line_lower for k in ['proteina', 'proteína', 'protein']):
-                val = _extract_num(line.split(':')[-1] if ':' in line else line)
-                if val > 0:
-                    protein = val
-            elif any(k in line_lower for k in ['carbohidrato', 'hidrato', 'carbohydrate', 'carbs']):
-                val = _extract_num(line.split(':')[-1] if ':' in line else line)
-                if val > 0:
-                    carbs = val
-            elif any(k in line_lower for k in ['grasa', 'fat', 'lípido', 'lipido']):
-                if 'saturad' not in line_lower:
-                    val = _extract_num(line.split(':')[-1] if ':' in line else line)
-                    if val > 0:
-                        fat = val
-        
-        # Añadir ingredientes al nombre
-        display_name = product_name
-        if ingredients:
-            display_name = f"{product_name} ({ingredients[:80]})"
-        
-        # CALORÍAS CALCULADAS POR PYTHON - NUNCA POR LA IA
-        calories_per_100g = _atwater_kcal(protein, carbs, fat)
-        
-        print(f"✅ Plato: {display_name} | Atwater: {calories_per_100g}kcal/100g")
-        print(f"   Macros/100g: P:{protein}g × 4 + C:{carbs}g × 4 + G:{fat}g × 9 = {calories_per_100g} kcal")
-        
-        if product_name == "Plato no identificado" and (protein == 0 and carbs == 0 and fat == 0):
-            return None
+        logger.debug("📸 Analizando plato de comida con Groq Llama 4 Scout...")
         
-        return NutritionalData(
-            food_name=display_name,
-            calories_per_100g=calories_per_100g,
-            protein_per_100g=protein,
-            carbs_per_100g=carbs,
-            fat_per_100g=fat,
-            source="groq_plate_analysis"
+        fields = _new_plate_fields()
+        response_text = await _stream_groq_vision_fields(
+            GROQ_PLATE_PROMPT, image_url, 0.2, _parse_plate_line, fields
         )
+        logger.debug("📸 Groq Plate Analysis Response:\n%s", response_text)
+        
+        return _plate_result(fields)
         
     except Exception as e:
-        print(f"  ⚠️ Groq Plate Analysis Error: {str(e)}")
+        logger.warning("⚠️ Groq Plate Analysis Error: %s", e)
         return None
 
 
+def _new_plate_fields() -> Dict:
+    """Campos del parser de platos con sus valores por defecto."""
+    return {
+        "name": "Plato no identificado",
+        "ingredients": "",
+        "protein": 0,
+        "carbs": 0,
+        "fat": 0,
+    }
+
+
+def _plate_result(fields: Dict) -> Optional[NutritionalData]:
+    """NutritionalData a partir de los campos parseados de un plato (None si no se identificó)."""
+    product_name = fields["name"]
+    ingredients = fields["ingredients"]
+    protein = fields["protein"]
+    carbs = fields["carbs"]
+    fat = fields["fat"]
+    
+    # Añadir ingredientes al nombre
+    display_name = product_name
+    if ingredients:
+        display_name = f"{product_name} ({ingredients[:80]})"
+    
+    # CALORÍAS CALCULADAS POR PYTHON - NUNCA POR LA IA
+    calories_per_100g = _atwater_kcal(protein, carbs, fat)
+    
+    logger.info("✅ Plato: %s | Atwater: %skcal/100g", display_name, calories_per_100g)
+    logger.debug(
+        "   Macros/100g: P:%sg × 4 + C:%sg × 4 + G:%sg × 9 = %s kcal",
+        protein, carbs, fat, calories_per_100g
+    )
+    
+    if product_name == "Plato no identificado" and (protein == 0 and carbs == 0 and fat == 0):
+        return None
+    
+    return NutritionalData(
+        food_name=display_name,
+        calories_per_100g=calories_per_100g,
+        protein_per_100g=protein,
+        carbs_per_100g=carbs,
+        fat_per_100g=fat,
+        source="groq_plate_analysis"
+    )
+
+
 # ==========================================
 # OPEN FOOD FACTS - BÚSQUEDA POR NOMBRE
 # ==========================================
 
+# Por petición a OFF/USDA en las búsquedas por nombre. Conectar debería ser
+# inmediato (conexiones keep-alive); si no, mejor fallar rápido
+NAME_SEARCH_TIMEOUT = aiohttp.ClientTimeout(total=3, connect=1)
+
+
 async def search_open_food_facts_by_name(food_name: str) -> Optional[NutritionalData]:
     """
     Busca un alimento por nombre en Open Food Facts.
@@ -1088,33 +1473,32 @@ async def search_open_food_facts_by_name(food_name: str) -> Optional[Nutritional
         url = f"{OFF_API_ENDPOINT}/search"
         params = {
             "q": food_name,
-            "fields": "product_name,nutrients",
+            **OFF_BARCODE_PARAMS,
             "page": 1,
             "page_size": 1
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                url,
-                params=params,
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as resp:
-                if resp.status != 200:
-                    return None
+        session = await get_http_session()
+        async with session.get(
+            url,
+            params=params,
+            timeout=NAME_SEARCH_TIMEOUT
+        ) as resp:
+            if resp.status != 200:
+                return None
                 
-                data = await resp.json()
+            data = orjson.loads(await resp.read())
         
         products = data.get("products", [])
         if not products:
             return None
         
         product = products[0]
-        nutrients = product.get("nutrients", {})
+        nutrients = product.get("nutriments", {})
         
-        calories = nutrients.get("energy_kcal_100g") or 0
-        protein = nutrients.get("proteins_100g") or 0
-        carbs = nutrients.get("carbohydrates_100g") or 0
-        fat = nutrients.get("fat_100g") or 0
+        calories, protein, carbs, fat = (
+            _first_present(nutrients, keys) for keys in OFF_NUTRIENT_KEYS.values()
+        )
         
         food_name_result = product.get("product_name", food_name)
         
@@ -1128,7 +1512,7 @@ async def search_open_food_facts_by_name(food_name: str) -> Optional[Nutritional
         )
         
     except Exception as e:
-        print(f"Error buscando en OFF por nombre: {str(e)}")
+        logger.warning("⚠️ Error buscando en OFF por nombre: %s", e)
         return None
 
 
@@ -1136,6 +1520,20 @@ async def search_open_food_facts_by_name(food_name: str) -> Optional[Nutritional
 # USDA FoodData Central - FALLBACK FINAL
 # ==========================================
 
+# Nombres EXACTOS de nutrientes USDA → (campo, unidad exigida o None).
+# Un lookup por nutriente en lugar de varias búsquedas de subcadenas
+_USDA_TARGETS = {
+    "Energy": ("calories", "KCAL"),
+    "Protein": ("protein", None),
+    "Carbohydrate, by difference": ("carbs", None),
+    "Total lipid (fat)": ("fat", None),
+}
+
+# Solo alimentos genéricos: los "Branded" son la mayoría del índice y traen fichas
+# mucho más pesadas (marca, ingredientes, raciones) que aquí no se usan
+USDA_DATA_TYPES = "Foundation,SR Legacy,Survey (FNDDS)"
+
+
 async def search_usda_food_data(food_name: str) -> Optional[NutritionalData]:
     """
     Busca un alimento en USDA FoodData Central API (fallback final si OFF no encuentra).
@@ -1163,19 +1561,20 @@ async def search_usda_food_data(food_name: str) -> Optional[NutritionalData]:
         params = {
             "query": food_name,
             "pageSize": 1,
+            "dataType": USDA_DATA_TYPES,
             # No requiere API Key (es público)
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                url,
-                params=params,
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as resp:
-                if resp.status != 200:
-                    return None
+        session = await get_http_session()
+        async with session.get(
+            url,
+            params=params,
+            timeout=NAME_SEARCH_TIMEOUT
+        ) as resp:
+            if resp.status != 200:
+                return None
                 
-                data = await resp.json()
+            data = orjson.loads(await resp.read())
         
         foods = data.get("foods", [])
         if not foods:
@@ -1189,25 +1588,23 @@ async def search_usda_food_data(food_name: str) -> Optional[NutritionalData]:
         # USDA devuelve "foodNutrients" como lista
         nutrients_list = food.get("foodNutrients", [])
         
-        calories = 0
-        protein = 0
-        carbs = 0
-        fat = 0
+        values = {"calories": 0, "protein": 0, "carbs": 0, "fat": 0}
         
-        # Buscar valores específicos en la lista
+        # Buscar valores específicos en la lista (USDA da valores por 100g)
         for nutrient in nutrients_list:
-            nutrient_name = nutrient.get("nutrient", {}).get("name", "").lower()
-            value = nutrient.get("value", 0)
-            
-            # USDA proporciona valores por 100g por defecto
-            if "energy" in nutrient_name and "kcal" in nutrient_name:
-                calories = value
-            elif "protein" in nutrient_name and "g" in nutrient_name:
-                protein = value
-            elif "carbohydrate" in nutrient_name:
-                carbs = value
-            elif "fat" in nutrient_name and "total" in nutrient_name:
-                fat = value
+            name = nutrient.get("nutrientName") or nutrient.get("nutrient", {}).get("name")
+            target = _USDA_TARGETS.get(name)
+            if target is None:
+                continue
+            field, unit = target
+            nutrient_unit = nutrient.get("unitName") or nutrient.get("nutrient", {}).get("unitName")
+            if unit and nutrient_unit and nutrient_unit.upper() != unit:
+                continue  # "Energy" viene dos veces: en KCAL y en kJ
+            values[field] = nutrient.get("value", 0)
+        
+        calories, protein, carbs, fat = (
+            values["calories"], values["protein"], values["carbs"], values["fat"]
+        )
         
         # Si no encontramos valores, retornar None
         if calories == 0 and protein == 0:
@@ -1223,7 +1620,7 @@ async def search_usda_food_data(food_name: str) -> Optional[NutritionalData]:
         )
         
     except Exception as e:
-        print(f"Error en USDA FoodData: {str(e)}")
+        logger.warning("⚠️ Error en USDA FoodData: %s", e)
         return None
 
 
@@ -1231,36 +1628,107 @@ async def search_usda_food_data(food_name: str) -> Optional[NutritionalData]:
 # ORQUESTACIÓN - FALLBACK PATTERN
 # ==========================================
 
+# Ventaja que se le da a OFF antes de aceptar la respuesta de USDA
+OFF_HEAD_START = 0.3
+
+# Los mismos ingredientes ("arroz blanco", "pollo") se repiten en muchas comidas.
+# Los nombres sin resultado se recuerdan menos: OFF/USDA pueden añadirlos
+FOOD_NAME_CACHE_TTL = 24 * 3600
+FOOD_NAME_NEGATIVE_TTL = 600
+_FOOD_NAME_L1 = TTLCache(maxsize=2048, ttl=FOOD_NAME_CACHE_TTL)
+
+# Tiempo máximo TOTAL de una búsqueda por nombre (OFF + USDA), por lenta que
+# vaya cada fuente. Un timeout no se cachea: es un fallo pasajero, no un "no existe"
+FOOD_NAME_LOOKUP_BUDGET = 6
+
+
 async def get_nutrition_by_food_name(food_name: str) -> Optional[NutritionalData]:
     """
-    Busca datos nutricionales con patrón FALLBACK.
+    Datos nutricionales por nombre, con caché en memoria delante de las APIs.
+    
+    La clave se normaliza (minúsculas, sin espacios sobrantes) para que
+    "Arroz blanco" y "arroz blanco " compartan entrada.
+    
+    ORDEN: L1 (memoria) → PostgreSQL (persistente) → OFF/USDA, estos
+    últimos con un presupuesto total de FOOD_NAME_LOOKUP_BUDGET segundos.
+    """
+    key = " ".join(food_name.lower().split())
+    result = _FOOD_NAME_L1.get(key, _MISSING)
+    if result is not _MISSING:
+        return result
+    
+    cache_key = f"nutri:name:{key}:v1"
+    result = await _persistent_cache_get(cache_key)
+    if result:
+        _FOOD_NAME_L1.set(key, result)
+        return result
     
-    ORDEN DE INTENTO:
+    try:
+        result = await asyncio.wait_for(
+            _search_food_name_apis(food_name), FOOD_NAME_LOOKUP_BUDGET
+        )
+    except asyncio.TimeoutError:
+        logger.warning("⏱️ Búsqueda de '%s' superó %ss", food_name, FOOD_NAME_LOOKUP_BUDGET)
+        return None
+    _FOOD_NAME_L1.set(key, result, None if result else FOOD_NAME_NEGATIVE_TTL)
+    if result:
+        _persistent_cache_put(cache_key, result)
+    return result
+
+
+async def _search_food_name_apis(food_name: str) -> Optional[NutritionalData]:
+    """
+    Busca datos nutricionales en OFF y USDA a la vez.
+    
+    PRIORIDAD:
     1. Open Food Facts (más completa, base de datos comunitaria)
-    2. USDA FoodData Central (fallback, base de datos oficial del USDA)
+    2. USDA FoodData Central (base de datos oficial del USDA)
     3. None (no encontrado)
     
+    Las dos consultas salen en paralelo: si OFF no encuentra nada, la
+    respuesta de USDA ya está en camino (latencia = la mayor, no la suma).
+    OFF tiene OFF_HEAD_START segundos de ventaja; pasado ese margen gana la
+    primera fuente que devuelva datos y la otra se cancela.
+    
     Args:
         food_name: Nombre del alimento
         
     Returns:
         NutritionalData si se encuentra. Los datos pueden venir de OFF o USDA
     """
+    off_task = asyncio.create_task(search_open_food_facts_by_name(food_name))
+    usda_task = asyncio.create_task(search_usda_food_data(food_name))
     
-    # Intento 1: Open Food Facts
-    result = await search_open_food_facts_by_name(food_name)
-    if result:
-        return result
-    
-    print(f"⏳ OFF no encontró '{food_name}', intentando USDA FoodData...")
-    
-    # Intento 2: USDA FoodData Central
-    result = await search_usda_food_data(food_name)
-    if result:
-        return result
-    
-    print(f"❌ No se encontraron datos para '{food_name}'")
-    return None
+    try:
+        done, _ = await asyncio.wait({off_task}, timeout=OFF_HEAD_START)
+        if done and off_task.result():
+            return off_task.result()
+        
+        remaining = [usda_task] if done else [off_task, usda_task]
+        for next_done in asyncio.as_completed(remaining):
+            result = await next_done
+            if result:
+                return result
+        
+        logger.info("❌ No se encontraron datos para '%s'", food_name)
+        return None
+    finally:
+        # La fuente que no ganó ya no hace falta
+        off_task.cancel()
+        usda_task.cancel()
+
+
+# Búsquedas por nombre simultáneas en TODO el proceso (no saturar OFF/USDA)
+ENRICH_CONCURRENCY = 8
+_ENRICH_SEMAPHORE: Optional[asyncio.Semaphore] = None
+
+
+def _get_enrich_semaphore() -> asyncio.Semaphore:
+    """Semáforo compartido (se crea dentro del event loop, en el primer uso)."""
+    global _ENRICH_SEMAPHORE
+    if _ENRICH_SEMAPHORE is None:
+        _ENRICH_SEMAPHORE = asyncio.Semaphore(ENRICH_CONCURRENCY)
+    return _ENRICH_SEMAPHORE
 
 
 async def process_gemini_and_enrich(
@@ -1274,75 +1742,108 @@ async def process_gemini_and_enrich(
     - Si viene de APIs (OFF/USDA), valida kcal contra Atwater.
     - NUNCA confía en kcal crudas de una IA sin validar.
     """
-    result = []
     foods = gemini_response.get("foods", [])
     
     if not foods:
-        return result
+        return []
     
-    for food in foods:
-        name = food.get("name") or food.get("alimento")
-        if not name:
-            continue
-        
-        estimated_grams = food.get("estimated_grams") or food.get("cantidad_g", 100)
-        if estimated_grams <= 0:
-            estimated_grams = 100
-        
-        nutrition = None
-        
-        # Opción 1: Usar datos ya normalizados de Groq (con Atwater aplicado)
-        if all(k in food for k in ["calories_per_100g", "protein_per_100g", "carbs_per_100g", "fat_per_100g"]):
-            try:
-                cal_100 = float(food["calories_per_100g"])
-                prot_100 = float(food["protein_per_100g"])
-                carbs_100 = float(food["carbs_per_100g"])
-                fat_100 = float(food["fat_per_100g"])
-                
-                # Validación Atwater final (seguridad extra)
-                cal_100 = _validate_and_fix_calories(cal_100, prot_100, carbs_100, fat_100)
-                
-                nutrition = NutritionalData(
-                    food_name=name,
-                    calories_per_100g=cal_100,
-                    protein_per_100g=prot_100,
-                    carbs_per_100g=carbs_100,
-                    fat_per_100g=fat_100,
-                    source="groq_atwater"
-                )
-            except (ValueError, TypeError):
-                pass
-        
-        # Opción 2: Buscar en APIs (Open Food Facts o USDA)
-        if not nutrition:
+    return await enrich_foods(foods)
+
+
+async def enrich_foods(foods: List[Dict]) -> List[Tuple[str, int, NutritionalData]]:
+    """
+    Enriquece todos los alimentos de una comida a la vez.
+    
+    Cada alimento puede acabar en una búsqueda HTTP por nombre; en paralelo,
+    una comida de 3 alimentos tarda lo que el más lento y no la suma.
+    El orden de la respuesta se conserva y un fallo aislado solo descarta ese alimento.
+    """
+    results = await asyncio.gather(*(_enrich_one(f) for f in foods), return_exceptions=True)
+    
+    enriched = []
+    for item in results:
+        # BaseException: un task cancelado devuelve CancelledError, que no es Exception
+        if isinstance(item, BaseException):
+            logger.warning("⚠️ Error enriqueciendo alimento: %r", item)
+        elif item:
+            enriched.append(item)
+    return enriched
+
+
+async def _enrich_one(food: Dict) -> Optional[Tuple[str, int, NutritionalData]]:
+    """
+    Resuelve un alimento de Groq: macros propios, APIs o valores por defecto.
+    
+    Solo la búsqueda en APIs pasa por el semáforo global; el resto es CPU.
+    """
+    name = food.get("name") or food.get("alimento")
+    if not name:
+        return None
+    
+    estimated_grams = food.get("estimated_grams") or food.get("cantidad_g", 100)
+    if estimated_grams <= 0:
+        estimated_grams = 100
+    
+    nutrition = None
+    
+    # Opción 1: Usar datos ya normalizados de Groq (con Atwater aplicado)
+    if all(k in food for k in ["calories_per_100g", "protein_per_100g", "carbs_per_100g", "fat_per_100g"]):
+        try:
+            cal_100 = float(food["calories_per_100g"])
+            prot_100 = float(food["protein_per_100g"])
+            carbs_100 = float(food["carbs_per_100g"])
+            fat_100 = float(food["fat_per_100g"])
+            
+            # Validación Atwater final (seguridad extra)
+            cal_100 = _validate_and_fix_calories(cal_100, prot_100, carbs_100, fat_100)
+            
+            nutrition = NutritionalData(
+                food_name=name,
+                calories_per_100g=cal_100,
+                protein_per_100g=prot_100,
+                carbs_per_100g=carbs_100,
+                fat_per_100g=fat_100,
+                source="groq_atwater"
+            )
+        except (ValueError, TypeError):
+            pass
+    
+    # Opción 2: Buscar en APIs (Open Food Facts o USDA)
+    if not nutrition:
+        async with _get_enrich_semaphore():
             api_result = await get_nutrition_by_food_name(name)
-            if api_result:
-                # Validar kcal de APIs también contra Atwater
-                api_result.calories_per_100g = _validate_and_fix_calories(
+        if api_result:
+            # Validar kcal de APIs también contra Atwater. Se crea un objeto
+            # nuevo: api_result puede venir compartido desde la caché
+            nutrition = NutritionalData(
+                food_name=api_result.food_name,
+                calories_per_100g=_validate_and_fix_calories(
                     api_result.calories_per_100g,
                     api_result.protein_per_100g,
                     api_result.carbs_per_100g,
                     api_result.fat_per_100g
-                )
-                nutrition = api_result
-        
-        # Opción 3: Valores por defecto razonables (con Atwater)
-        if not nutrition:
-            default_prot = 10.0
-            default_carbs = 20.0
-            default_fat = 5.0
-            nutrition = NutritionalData(
-                food_name=name,
-                calories_per_100g=_atwater_kcal(default_prot, default_carbs, default_fat),
-                protein_per_100g=default_prot,
-                carbs_per_100g=default_carbs,
-                fat_per_100g=default_fat,
-                source="default"
+                ),
+                protein_per_100g=api_result.protein_per_100g,
+                carbs_per_100g=api_result.carbs_per_100g,
+                fat_per_100g=api_result.fat_per_100g,
+                source=api_result.source
             )
-        
-        result.append((name, estimated_grams, nutrition))
     
-    return result
+    # Opción 3: Valores por defecto razonables (con Atwater)
+    if not nutrition:
+        default_prot = 10.0
+        default_carbs = 20.0
+        default_fat = 5.0
+        nutrition = NutritionalData(
+            food_name=name,
+            calories_per_100g=_atwater_kcal(default_prot, default_carbs, default_fat),
+            protein_per_100g=default_prot,
+            carbs_per_100g=default_carbs,
+            fat_per_100g=default_fat,
+            source="default"
+        )
+    
+    return (name, estimated_grams, nutrition)
 
 
 # ==========================================
@@ -1365,12 +1866,12 @@ def is_valid_barcode(text: str) -> bool:
         True si parece un código de barras
     """
     
-    # Solo debe contener dígitos
-    if not text.isdigit():
+    # Debe tener longitud típica de EAN (O(1): descarta textos largos sin recorrerlos)
+    if not (8 <= len(text) <= 14):
         return False
     
-    # Debe tener longitud típica de EAN
-    if not (8 <= len(text) <= 14):
+    # Solo debe contener dígitos
+    if not text.isdigit():
         return False
     
     # No debe comenzar por números que sean tipicamente descripciones
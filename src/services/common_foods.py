@@ -0,0 +1,127 @@
+"""
+Resolución local de alimentos comunes (sin LLM).
+
+Muchos mensajes son alimentos sueltos y conocidos ("manzana", "pollo 200g",
+"2 huevos y una tostada"). Se resuelven con la tabla de common_foods.json
+(valores por 100g del USDA) sin pasar por Groq, que tarda 0.5-2 s por llamada.
+
+REGLAS:
+- El texto se divide en trozos por comas, "+", ";", saltos de línea e " y "
+- Cada trozo debe ser: [cantidad] alimento [cantidad]
+    · "200g", "200 gr", "200 gramos" → gramos
+    · número sin unidad ≤ 20 → unidades (× ración estándar)
+    · sin cantidad (o "un/una") → una ración estándar
+- Si UN SOLO trozo no está en la tabla se devuelve None y se usa Groq
+- Las calorías se calculan con Atwater, nunca se leen de la tabla
+"""
+
+import logging
+import re
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+
+from src.services.api_services import NutritionalData, _atwater_kcal
+
+logger = logging.getLogger(__name__)
+
+
+COMMON_FOODS_PATH = Path(__file__).with_name("common_foods.json")
+
+# Un número sin unidad por encima de esto se interpreta como gramos ("pollo 200")
+MAX_UNITS = 20
+
+# Etiqueta inicial tipo "Desayuno:" o "Cena -"
+_LABEL_RE = re.compile(r'^[^\d:,]{1,20}(?::|\s-)\s*')
+_SPLIT_RE = re.compile(r'\s*(?:[,;+\n]|\s+y\s+|\s+e\s+)\s*')
+_QTY = r'(\d+)\s*(g|gr|grs|gramos|grams|ml)?'
+_ITEM_RE = re.compile(
+    rf'^(?:{_QTY}\s+(?:de\s+)?)?(?:(?:un|una|unos|unas)\s+)?(\D+?)(?:\s+{_QTY})?$'
+)
+
+
+def _normalize(text: str) -> str:
+    """Minúsculas, sin tildes y con espacios simples ("Plátano  " → "platano")."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+def _load_common_foods() -> Dict[str, Tuple[NutritionalData, int]]:
+    """Carga la tabla JSON a un dict nombre/alias → (NutritionalData, ración en g)."""
+    try:
+        raw = orjson.loads(COMMON_FOODS_PATH.read_bytes())
+    except (OSError, ValueError) as e:
+        logger.warning("⚠️ No se pudo cargar %s: %s", COMMON_FOODS_PATH.name, e)
+        return {}
+
+    foods = {}
+    for key, item in raw.items():
+        nutrition = NutritionalData(
+            food_name=item["name"],
+            calories_per_100g=_atwater_kcal(item["protein"], item["carbs"], item["fat"]),
+            protein_per_100g=item["protein"],
+            carbs_per_100g=item["carbs"],
+            fat_per_100g=item["fat"],
+            source="local"
+        )
+        entry = (nutrition, item["portion_g"])
+        for name in [key, *item.get("aliases", [])]:
+            foods[_normalize(name)] = entry
+    return foods
+
+
+_COMMON_FOODS = _load_common_foods()
+
+
+def _parse_grams(amount: Optional[str], unit: Optional[str], portion_g: int) -> int:
+    """Convierte la cantidad escrita por el usuario en gramos."""
+    if amount is None:
+        return portion_g
+    value = int(amount)
+    if unit is None and value <= MAX_UNITS:
+        return value * portion_g
+    return value
+
+
+def match_common_foods(text: str) -> Optional[List[Tuple[str, int, NutritionalData]]]:
+    """
+    Intenta resolver el mensaje completo con la tabla local.
+
+    Returns:
+        Lista (food_name, gramos, NutritionalData) con el mismo formato que
+        process_gemini_and_enrich, o None si algún alimento no es conocido.
+    """
+    if not _COMMON_FOODS:
+        return None
+
+    text = _LABEL_RE.sub("", _normalize(text), count=1)
+    if not text:
+        return None
+
+    result = []
+    for chunk in _SPLIT_RE.split(text):
+        if not chunk:
+            continue
+        match = _ITEM_RE.match(chunk)
+        if not match:
+            return None
+
+        pre_amount, pre_unit, name, post_amount, post_unit = match.groups()
+        if pre_amount and post_amount:
+            return None  # "2 huevos 100g": ambiguo, mejor que lo interprete Groq
+
+        entry = _COMMON_FOODS.get(name.strip())
+        if entry is None:
+            return None
+
+        nutrition, portion_g = entry
+        amount, unit = (pre_amount, pre_unit) if pre_amount else (post_amount, post_unit)
+        grams = _parse_grams(amount, unit, portion_g)
+        if grams <= 0:
+            return None
+        result.append((nutrition.food_name, grams, nutrition))
+
+    return result or None
@@ -0,0 +1,453 @@
+"""
+Procesamiento de imágenes para la detección de códigos de barras.
+
+Las librerías de visión (OpenCV, numpy, pyzbar) tardan segundos en
+importarse, así que NO se cargan al arrancar el bot: se importan la primera
+vez que llega una foto (ver _load_cv_libs) y quedan en caché para el resto.
+"""
+
+import logging
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional
+
+from src.config import BARCODE_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+# ==========================================
+# POOL DE HILOS PARA VISIÓN
+# ==========================================
+
+# Pool propio (no el por defecto de asyncio.to_thread, que comparten otras tareas).
+# Hilos y no procesos: OpenCV libera el GIL en sus kernels y pyzbar llama a zbar
+# vía ctypes, que también lo libera, así que los hilos avanzan en paralelo sin
+# pagar el pickling de la imagen ni arrancar intérpretes nuevos.
+CV_EXECUTOR = ThreadPoolExecutor(
+    max_workers=BARCODE_WORKERS,
+    thread_name_prefix="barcode",
+)
+
+# Las rotaciones de una misma foto van a un pool aparte: sus tareas nunca
+# esperan a otras, así que no hay riesgo de bloqueo aunque CV_EXECUTOR esté lleno
+ROTATION_EXECUTOR = ThreadPoolExecutor(
+    max_workers=BARCODE_WORKERS,
+    thread_name_prefix="barcode-rot",
+)
+
+
+# ==========================================
+# CARGA PEREZOSA DE LIBRERÍAS PESADAS
+# ==========================================
+
+_cv2 = None
+_np = None
+_pyzbar_decode = None
+PYZBAR_AVAILABLE = False
+
+# Objetos de OpenCV reutilizables (se crean al cargar cv2)
+_STRUCT_ELEM = None
+# CLAHE guarda buffers internos: uno por hilo del pool en lugar de uno por rotación
+_thread_local = threading.local()
+
+# Secuencia de dígitos EAN/UPC dentro de un payload con otros caracteres
+_DIGIT_RE = re.compile(r'(\d{8,14})')
+
+
+def _load_cv_libs() -> None:
+    """Importa OpenCV, numpy y pyzbar en la primera llamada (no-op después)."""
+    global _cv2, _np, _pyzbar_decode, PYZBAR_AVAILABLE, _STRUCT_ELEM
+    
+    if _cv2 is not None:
+        return
+    
+    import numpy
+    
+    try:
+        from pyzbar.pyzbar import decode
+        _pyzbar_decode = decode
+        PYZBAR_AVAILABLE = True
+    except ImportError:
+        PYZBAR_AVAILABLE = False
+        logger.warning("⚠️ pyzbar no disponible. Instalando: pip install pyzbar")
+    
+    import cv2
+    
+    _np = numpy
+    _STRUCT_ELEM = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    _cv2 = cv2  # Último: marca la carga como completa
+
+
+def _get_clahe():
+    """CLAHE del hilo actual (se crea una vez por hilo y se reutiliza)."""
+    clahe = getattr(_thread_local, "clahe", None)
+    if clahe is None:
+        clahe = _cv2.createCLAHE(clipLimit=2.5, tileGridSize=(6, 6))
+        _thread_local.clahe = clahe
+    return clahe
+
+
+# ==========================================
+# DETECCIÓN DE CÓDIGOS DE BARRAS
+# ==========================================
+
+# Lado mayor con el que se procesa la foto. Un móvil manda 12 MP y el código ocupa
+# una fracción: a 1600 px sigue siendo legible y cada paso trabaja ~6x menos píxeles
+MAX_DECODE_EDGE = 1600
+
+# Marcadores SOF de JPEG (llevan las dimensiones); C4, C8 y CC son otra cosa
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _image_long_edge(image_bytes: bytes) -> Optional[int]:
+    """
+    Lado mayor de la imagen leído de la cabecera JPEG/PNG, sin decodificarla.
+    
+    Devuelve None si el formato no se reconoce (se decodifica a tamaño completo).
+    """
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n" and len(image_bytes) >= 24:
+        width = int.from_bytes(image_bytes[16:20], "big")
+        height = int.from_bytes(image_bytes[20:24], "big")
+        return max(width, height)
+    
+    if image_bytes[:2] != b"\xff\xd8":
+        return None
+    
+    i, size = 2, len(image_bytes)
+    while i + 9 < size:
+        if image_bytes[i] != 0xFF:
+            return None
+        marker = image_bytes[i + 1]
+        if marker == 0xFF:  # Byte de relleno
+            i += 1
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height = int.from_bytes(image_bytes[i + 5:i + 7], "big")
+            width = int.from_bytes(image_bytes[i + 7:i + 9], "big")
+            return max(width, height)
+        if 0xD0 <= marker <= 0xD9 or marker == 0x01:  # Marcadores sin longitud
+            i += 2
+            continue
+        i += 2 + int.from_bytes(image_bytes[i + 2:i + 4], "big")
+    return None
+
+
+def _reduced_decode_flag(image_bytes: bytes):
+    """
+    Flag de imdecode que decodifica ya reducido (1/2 o 1/4) sin bajar de MAX_DECODE_EDGE.
+    
+    El decodificador JPEG de OpenCV se salta coeficientes DCT al reducir: es
+    más rápido que decodificar completo y luego hacer resize.
+    """
+    cv2 = _cv2
+    long_edge = _image_long_edge(image_bytes)
+    if long_edge is None:
+        return cv2.IMREAD_GRAYSCALE
+    if long_edge >= 4 * MAX_DECODE_EDGE:
+        return cv2.IMREAD_REDUCED_GRAYSCALE_4
+    if long_edge >= 2 * MAX_DECODE_EDGE:
+        return cv2.IMREAD_REDUCED_GRAYSCALE_2
+    return cv2.IMREAD_GRAYSCALE
+
+
+def extract_barcode_sync(image_bytes: bytes) -> Optional[str]:
+    """
+    Versión síncrona de extract_barcode_from_image (se ejecuta fuera del event loop).
+    
+    ESTRATEGIA:
+    1. Escala de grises directa a 0° (la foto típica sale aquí, sin lanzar hilos)
+    2. Las 4 rotaciones (0°, 90°, 180°, 270°) EN PARALELO, cada una con la
+       escalera completa de _try_all_strategies; gana la primera que acierte
+       y las demás se detienen en su siguiente paso
+    3. Escala de grises a resolución nativa (solo si la foto se redujo)
+    
+    Las fotos de más de MAX_DECODE_EDGE px se reducen antes de empezar: las
+    muy grandes se decodifican ya a 1/2 o 1/4 y el resto con resize.
+    """
+    _load_cv_libs()
+    np, cv2 = _np, _cv2
+    
+    try:
+        # Decodificar directamente a escala de grises: un solo buffer para toda
+        # la escalera (pyzbar solo usaría un canal del RGB de todas formas)
+        buffer = np.frombuffer(image_bytes, np.uint8)
+        decode_flag = _reduced_decode_flag(image_bytes)
+        gray_base = cv2.imdecode(buffer, decode_flag)
+        if gray_base is None:
+            logger.warning("❌ No se pudo decodificar la imagen")
+            return None
+        
+        # Reducir fotos grandes antes de la escalera (INTER_AREA conserva los bordes finos)
+        gray_native = gray_base if decode_flag == cv2.IMREAD_GRAYSCALE else None
+        scale = MAX_DECODE_EDGE / max(gray_base.shape)
+        if scale < 1.0:
+            gray_base = cv2.resize(gray_base, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        
+        # Camino rápido: la mayoría de fotos nítidas se leen sin preprocesar
+        result = _try_pyzbar_decode(gray_base, "Gray 0°")
+        if result:
+            return result
+        
+        result = _try_rotations_parallel(gray_base)
+        if result:
+            return result
+        
+        # Último recurso: códigos muy pequeños que no sobreviven a la reducción
+        # (si se decodificó reducida, se paga ahora la decodificación completa)
+        if gray_native is None:
+            gray_native = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+        if gray_native is not None and gray_native is not gray_base:
+            result = _try_pyzbar_decode(gray_native, "Gray nativa")
+            if result:
+                return result
+        
+        logger.info("❌ No se detectó código de barras con ninguna estrategia")
+        return None
+        
+    except Exception as e:
+        logger.error("❌ Error general en extract_barcode: %s", e)
+        return None
+
+
+def _try_rotations_parallel(gray_base) -> Optional[str]:
+    """
+    Lanza las 4 rotaciones en ROTATION_EXECUTOR y devuelve el primer acierto.
+    
+    Son independientes entre sí, y OpenCV/zbar liberan el GIL, así que en
+    una máquina con varios núcleos las orientaciones difíciles (foto de
+    lado o del revés) ya no esperan a que fallen las anteriores.
+    """
+    stop = threading.Event()
+    pending = {
+        ROTATION_EXECUTOR.submit(_try_all_strategies, gray_base, angle, stop)
+        for angle in (0, 90, 180, 270)
+    }
+    
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result:
+                    return result
+        return None
+    finally:
+        # Las que no han empezado se cancelan; las que corren paran en su siguiente paso
+        stop.set()
+        for future in pending:
+            future.cancel()
+
+
+def _try_all_strategies(gray_base, angle: int, stop: threading.Event) -> Optional[str]:
+    """
+    Escalera de preprocesados para una rotación (de más barato a más caro).
+    
+    1. Escala de grises (a 0° ya se probó en el camino rápido)
+    2. Invertida y ecualizada (operaciones de un solo paso)
+    3. CLAHE, umbral adaptativo + morfología, blur + Otsu
+    4. Ampliación x2 para códigos pequeños o lejanos
+    
+    Se comprueba `stop` antes de cada paso: si otra rotación ya acertó, se abandona.
+    """
+    cv2 = _cv2
+    
+    # np.rot90 es una vista sin copia (y sin recortar esquinas como PIL.rotate);
+    # OpenCV necesita memoria contigua, así que se compacta una vez por rotación
+    if angle > 0:
+        gray = _np.ascontiguousarray(_np.rot90(gray_base, k=angle // 90))
+    else:
+        gray = gray_base
+    
+    def _inverted():
+        return cv2.bitwise_not(gray)
+    
+    def _equalized():
+        return cv2.equalizeHist(gray)
+    
+    def _enhanced():
+        # CLAHE Enhanced (contraste mejorado por zonas)
+        return _get_clahe().apply(gray)
+    
+    def _morphology():
+        # Umbral adaptativo + operaciones morfológicas (especial para códigos oscuros)
+        thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                       cv2.THRESH_BINARY, 11, 2)
+        morph = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, _STRUCT_ELEM, iterations=1)
+        return cv2.morphologyEx(morph, cv2.MORPH_OPEN, _STRUCT_ELEM, iterations=1)
+    
+    def _blurred_otsu():
+        # Gaussian blur + Otsu (umbral automático según el histograma)
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return thresh
+    
+    def _upscaled():
+        # Ampliación x2 (barras demasiado finas para zbar)
+        return cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    
+    strategies = [
+        ("Inverted", _inverted),
+        ("Equalized", _equalized),
+        ("Enhanced", _enhanced),
+        ("Morphology", _morphology),
+        ("Blurred+Otsu", _blurred_otsu),
+        ("Upscaled", _upscaled),
+    ]
+    if angle > 0:
+        strategies.insert(0, ("Gray", lambda: gray))
+    
+    for name, preprocess in strategies:
+        if stop.is_set():
+            return None
+        try:
+            result = _try_pyzbar_decode(preprocess(), f"{name} {angle}°")
+            if result:
+                return result
+        except Exception:
+            pass
+    
+    return None
+
+
+def _try_pyzbar_decode(img_array, strategy_name: str) -> Optional[str]:
+    """
+    Intenta decodificar código de barras con pyzbar.
+    
+    Args:
+        img_array: Array de imagen (RGB, Gray, etc)
+        strategy_name: Nombre de la estrategia (para logging)
+    
+    Returns:
+        String del código o None
+    """
+    if not PYZBAR_AVAILABLE:
+        return None
+    
+    try:
+        decoded_objects = _pyzbar_decode(img_array)
+        
+        for obj in decoded_objects:
+            barcode = obj.data.decode('utf-8').strip()
+            
+            # Validar que sea código de barras válido (8-14 dígitos)
+            if barcode.isdigit() and 8 <= len(barcode) <= 14:
+                logger.info("✅ DETECTADO %s: %s", strategy_name, barcode)
+                return barcode
+            elif barcode and len(barcode) > 0:
+                # Extraer secuencia de dígitos si hay otros caracteres
+                digits = _DIGIT_RE.search(barcode)
+                if digits:
+                    code = digits.group(1)
+                    logger.info("✅ DETECTADO %s (limpiado): %s", strategy_name, code)
+                    return code
+    
+    except Exception as e:
+        pass
+    
+    return None
+
+
+# ==========================================
+# PREPARACIÓN DE IMÁGENES PARA EL LLM
+# ==========================================
+
+# El modelo de visión no aprovecha más de ~1024 px: una foto de móvil de
+# 3-8 MB se queda en ~100-200 KB y la subida (y el base64) es 10x menor
+LLM_MAX_SIDE = 1024
+LLM_JPEG_QUALITY = 80
+# Por encima de este tamaño compensa recomprimir aunque las dimensiones ya valgan
+RECOMPRESS_MIN_BYTES = 1024 * 1024
+
+
+def needs_recompression(image_bytes: bytes) -> bool:
+    """PNG, fotos de más de 1 MB o de más de LLM_MAX_SIDE px: se envían recomprimidas."""
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n" or len(image_bytes) > RECOMPRESS_MIN_BYTES:
+        return True
+    long_edge = _image_long_edge(image_bytes)
+    return long_edge is not None and long_edge > LLM_MAX_SIDE
+
+
+def recompress_jpeg_sync(image_bytes: bytes) -> bytes:
+    """
+    Reduce la imagen a LLM_MAX_SIDE px de lado mayor y la recodifica como JPEG.
+    
+    Es ancho de banda hacia Groq, no memoria local: un PNG o una foto de
+    varios MB se queda en una fracción. Si algo falla, devuelve el original.
+    """
+    _load_cv_libs()
+    np, cv2 = _np, _cv2
+    
+    try:
+        img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return image_bytes
+        scale = LLM_MAX_SIDE / max(img.shape[:2])
+        if scale < 1.0:
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, LLM_JPEG_QUALITY])
+        if not ok or len(encoded) >= len(image_bytes):
+            return image_bytes
+        return encoded.tobytes()
+    except Exception as e:
+        logger.warning("⚠️ No se pudo recomprimir la imagen: %s", e)
+        return image_bytes
+
+
+# ==========================================
+# OCR RÁPIDO (PRE-FILTRO DE ETIQUETAS)
+# ==========================================
+
+# pytesseract es opcional y además necesita el binario tesseract: se comprueba
+# en el primer uso (None = aún no comprobado) y sin él no hay pre-filtro
+_pytesseract = None
+PYTESSERACT_AVAILABLE: Optional[bool] = None
+
+# Para saber si hay números y palabras clave basta una versión pequeña
+OCR_MAX_WIDTH = 800
+# Un OCR lento se abandona: no puede costar más que la llamada que intenta ahorrar
+OCR_TIMEOUT = 2
+
+
+def _load_pytesseract() -> bool:
+    """Importa pytesseract y comprueba el binario en la primera llamada."""
+    global _pytesseract, PYTESSERACT_AVAILABLE
+    
+    if PYTESSERACT_AVAILABLE is None:
+        try:
+            import pytesseract
+            pytesseract.get_tesseract_version()  # Falla si falta el binario
+            _pytesseract = pytesseract
+            PYTESSERACT_AVAILABLE = True
+        except Exception:
+            PYTESSERACT_AVAILABLE = False
+            logger.info("ℹ️ pytesseract/tesseract no disponible: sin pre-filtro OCR de etiquetas")
+    return PYTESSERACT_AVAILABLE
+
+
+def ocr_text_sync(image_bytes: bytes) -> Optional[str]:
+    """
+    Texto de la imagen con tesseract, a OCR_MAX_WIDTH px de ancho como máximo.
+    
+    Returns:
+        El texto leído, o None si el OCR no está disponible o falla
+        (el llamador no debe descartar nada en ese caso)
+    """
+    if not _load_pytesseract():
+        return None
+    
+    _load_cv_libs()
+    np, cv2 = _np, _cv2
+    
+    try:
+        gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            return None
+        scale = OCR_MAX_WIDTH / gray.shape[1]
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return _pytesseract.image_to_string(gray, timeout=OCR_TIMEOUT)
+    except Exception as e:
+        logger.debug("OCR no disponible para esta imagen: %s", e)
+        return None